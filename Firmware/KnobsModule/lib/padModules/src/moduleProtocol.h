@@ -2,6 +2,9 @@
 
 #define TWI_BUFFER_SIZE 3
 
+// bumped every time the protocol gets something new. 2: dirty bitmap + descriptor
+#define MOONPAD_PROTOCOL_VERSION 2
+
 // This is a really bad place to put this, but it is the only place that comes to my mind
 enum
 {
@@ -14,6 +17,16 @@ enum
 {
     MOONPAD_BASE_FRIEND_CODE = 0x01,
     MOONPAD_BASE_SWAP_ADDRESS = 0x02,
+    MOONPAD_BASE_DESCRIPTOR = 0x03,
+};
+
+/// @brief What the module is and what its frames look like. The master asks for it once per friend code.
+struct ModuleDescriptor
+{
+    uint8_t module_type;
+    uint8_t protocol_version;
+    uint8_t control_count; // encoders, sliders...
+    uint8_t frame_size;    // sizeof the changes struct
 };
 
 enum
@@ -21,6 +34,8 @@ enum
     MOONPAD_KNOBS_GET_CHANGES = 0x01,
     MOONPAD_KNOBS_CLEAR_CHANGES = 0x02,
     MOONPAD_KNOBS_GET_ENCODER_NUMBER = 0x03,
+    // one byte, bit N set when encoder N has changes waiting. idle modules only cost this byte per poll
+    MOONPAD_KNOBS_GET_DIRTY = 0x04,
 };
 
 enum
@@ -28,6 +43,8 @@ enum
     MOONPAD_SLIDERS_GET_CHANGES = 0x01,
     MOONPAD_SLIDERS_CLEAR_CHANGES = 0x02,
     MOONPAD_SLIDERS_GET_SLIDER_NUMBER = 0x03,
+    // one byte, bit N set when slider N has changes waiting. idle modules only cost this byte per poll
+    MOONPAD_SLIDERS_GET_DIRTY = 0x04,
 };
 
 enum
@@ -5,7 +5,6 @@
 #include <Wire.h>
 
 uint8_t i2c_buffer[TWI_BUFFER_SIZE];
-ModuleBase modBase(MOONPAD_MOD_KNOBS);
 
 #define NUM_ENCODERS 3
 
@@ -29,6 +28,7 @@ struct KnobChanges
 };
 
 KnobChanges changes = {{0}, {0}, {0}};
+ModuleBase modBase(MOONPAD_MOD_KNOBS, NUM_ENCODERS, sizeof(KnobChanges));
 long encoder_positions[NUM_ENCODERS] = {0, 0, 0};
 
 void setup()
@@ -112,9 +112,22 @@ void ModuleBase::onRequest()
       memset((void *)&changes, 0, sizeof(changes));
     }
 
+    if (module_cmd == MOONPAD_KNOBS_GET_DIRTY)
+    {
+      uint8_t dirty = 0;
+      for (uint8_t i = 0; i < NUM_ENCODERS; i++)
+      {
+        if (changes.rotation_delta[i] || changes.button_pressed[i] || changes.button_released[i])
+        {
+          dirty |= 1 << i;
+        }
+      }
+      Wire.write(dirty);
+    }
+
     if (module_cmd == MOONPAD_KNOBS_GET_ENCODER_NUMBER)
     {
-      Wire.write((uint8_t *)NUM_ENCODERS, 1);
+      Wire.write((uint8_t)NUM_ENCODERS);
     }
   }
   return;
@@ -1,8 +1,14 @@
+from collections import OrderedDict
 from enum import Enum
+import struct
 from kmk.modules import Module
 from twiman import TWIDevice, TWIManager
 
 
+# the first protocol version with the dirty byte command. older firmware answers it with 0xFF
+DIRTY_VERSION = 2
+
+
 class ModuleType(Enum):
     KNOBS = (0x01,)  # i love ruff.
     SLIDERS = (0x02,)
@@ -17,11 +23,27 @@ class BaseModule(Module):
         self.target_type_id = target_type_id.value[
             0  # I think this is right because is a tuple with one element
         ]
-        self.devices = []
+        # (channel, addr) -> device, in the order they showed up
+        self.devices = OrderedDict()
         self.keyboard = None
 
-        twiman.add_device_callback(self.twiman_new_device_callback)
-        twiman.add_removal_callback(self.twiman_removed_device_callback)
+        # adaptive polling (ms). devices are polled every poll_fast_ms while they move and for poll_hold_ms after,
+        # then the interval gets multiplied by poll_decay every quiet poll until it reaches poll_idle_ms.
+        self.poll_fast_ms = 10
+        self.poll_idle_ms = 100
+        self.poll_hold_ms = 500
+        self.poll_decay = 2
+
+        self.frame_formats = {}  # control count -> struct format of the module's changes frame
+
+        # (channel, addr) -> index of the device's first control. rebuilt on hot-plug only.
+        self.control_index = {}
+        # keep a replugged module on the same indices, keyed by friend code. a new module gets the lowest
+        # free range, taking it from modules that aren't plugged in if it has to, so indices stay within the map.
+        # with a ModuleRegistry the pins survive reboots too, so they're on by default.
+        self.pin_controls = twiman.registry is not None
+        self.pinned_controls = {}  # friend code -> (first index, count)
+        self.load_pinned_controls()
 
     def twiman_new_device_callback(self, device: TWIDevice):
         return
@@ -29,6 +51,133 @@ class BaseModule(Module):
     def twiman_removed_device_callback(self, device: TWIDevice):
         return
 
+    def add_device(self, device: TWIDevice):
+        """Start tracking a device of ours"""
+        self.devices[(device.channel, device.addr)] = device
+        self.rebuild_control_index()
+
+    def pop_device(self, device: TWIDevice):
+        """Stop tracking a device. Returns our own copy of it, or None if it wasn't ours"""
+        ours = self.devices.pop((device.channel, device.addr), None)
+        if ours is not None:
+            self.rebuild_control_index()
+        return ours
+
+    def control_count(self, device: TWIDevice):
+        """How many controls (knobs, sliders...) a device has"""
+        return 0
+
+    def load_pinned_controls(self):
+        """Load the control slots of the modules we've seen on previous boots"""
+        if self.twiman.registry is None:
+            return
+        for friend_code, entry in self.twiman.registry.entries_for_type(
+            self.target_type_id
+        ):
+            if "slot" not in entry:
+                continue
+            self.pinned_controls[friend_code] = (entry["slot"], entry.get("count", 0))
+
+    def get_known_count(self, device: TWIDevice):
+        """The control count of a module we've seen before, or None. Saves asking the module again."""
+        if device.descriptor is not None:
+            return device.descriptor.count
+        if self.twiman.registry is None:
+            return None
+        entry = self.twiman.registry.get(device.get_friend_code())
+        return entry.get("count") if entry else None
+
+    def remember_count(self, device: TWIDevice, count: int):
+        if self.twiman.registry is not None and count:
+            self.twiman.registry.update(device.get_friend_code(), count=count)
+
+    def build_frame_format(self, count: int):
+        """The struct format of a frame with count controls"""
+        raise NotImplementedError
+
+    def get_frame_format(self, device: TWIDevice, count: int):
+        """The struct format for a device's frames, built once per count.
+        Returns None if the device says its frames look different."""
+        frame_format = self.frame_formats.get(count)
+        if frame_format is None:
+            frame_format = self.frame_formats[count] = self.build_frame_format(count)
+
+        descriptor = device.descriptor
+        if descriptor is not None and descriptor.frame_size != struct.calcsize(
+            frame_format
+        ):
+            print(
+                f"{device.get_friend_code()}: unknown frame layout ({descriptor.frame_size} bytes, v{descriptor.version})"
+            )
+            return None
+        return frame_format
+
+    def has_dirty_byte(self, device: TWIDevice):
+        """If the device's firmware can say whether anything changed, so idle polls cost a byte.
+        Without a descriptor it's old firmware and the whole frame is read every time."""
+        descriptor = device.descriptor
+        return descriptor is not None and descriptor.version >= DIRTY_VERSION
+
+    def rebuild_control_index(self):
+        """Rebuild the control index table. Call it after self.devices changes."""
+        self.control_index.clear()
+        if self.pin_controls:
+            self.rebuild_pinned_index()
+            return
+
+        next_index = 0
+        for device in self.devices.values():
+            self.control_index[(device.channel, device.addr)] = next_index
+            next_index += self.control_count(device)
+
+    def rebuild_pinned_index(self):
+        # the plugged in modules that already have a range keep it, the others get one after that
+        taken = []  # (first index, end) of the ranges of plugged in modules
+        new_devices = []
+        for device in self.devices.values():
+            pinned = self.pinned_controls.get(device.get_friend_code())
+            if pinned is None:
+                new_devices.append(device)
+                continue
+            self.control_index[(device.channel, device.addr)] = pinned[0]
+            taken.append((pinned[0], pinned[0] + pinned[1]))
+
+        for device in new_devices:
+            count = self.control_count(device)
+            base = self.allocate_range(count, taken)
+            taken.append((base, base + count))
+            friend_code = device.get_friend_code()
+            self.pinned_controls[friend_code] = (base, count)
+            if self.twiman.registry is not None:
+                self.twiman.registry.update(friend_code, slot=base, count=count)
+            self.control_index[(device.channel, device.addr)] = base
+
+    def allocate_range(self, count: int, taken):
+        """The lowest first index of count free controls. Modules that aren't plugged in and were pinned
+        somewhere in there lose their pin, they get a new range when they come back."""
+        base = 0
+        for start, end in sorted(taken):
+            if base + count <= start:
+                break
+            base = max(base, end)
+
+        end = base + count
+        for friend_code, (start, pinned_count) in list(self.pinned_controls.items()):
+            if start < end and base < start + pinned_count:
+                del self.pinned_controls[friend_code]
+                if self.twiman.registry is not None:
+                    self.twiman.registry.forget(friend_code, "slot")
+        return base
+
+    def get_control_index(self, device: TWIDevice, control_idx: int):
+        """A stable index for a control of a device"""
+        return self.control_index[(device.channel, device.addr)] + control_idx
+
+    def handle_frame(self, device: TWIDevice):
+        """Called by the TWIManager poll pass when a fresh frame is in device.rx_buffer.
+        Return True if anything moved, it keeps the device on the fast poll rate."""
+        return False
+
     def mod_during_bootup(self, keyboard):
         """Called during the bootup process of the keyboard."""
         return
@@ -36,6 +185,14 @@ class BaseModule(Module):
     def during_bootup(self, keyboard):
         self.keyboard = keyboard
         self.mod_during_bootup(keyboard)
+        # registered here and not in __init__ so subclasses are fully set up when
+        # the devices that showed up before bootup get replayed to us.
+        self.twiman.add_device_callback(
+            self.twiman_new_device_callback, self.target_type_id
+        )
+        self.twiman.add_removal_callback(
+            self.twiman_removed_device_callback, self.target_type_id
+        )
 
     def before_matrix_scan(self, keyboard):
         return
@@ -0,0 +1,81 @@
+from kmk.extensions.display import BarsEntry, TextEntry
+
+
+# Live entries for the Display extension. The display calls update(keyboard) at most max_fps times a second,
+# a widget returns True when it changed and the display re-renders once for all of them.
+# So a slider going crazy is still just max_fps OLED transfers a second.
+
+
+class LayerWidget(TextEntry):
+    """The active layer"""
+
+    def __init__(self, fmt="layer {}", **kwargs):
+        super().__init__(**kwargs)
+        self.fmt = fmt
+        self.shown = None
+
+    def update(self, keyboard):
+        layer = keyboard.active_layers[0]
+        if layer == self.shown:
+            return False
+        self.shown = layer
+        self.text = self.fmt.format(layer)
+        return True
+
+
+class KnobWidget(TextEntry):
+    """The last knob that was turned and its value"""
+
+    def __init__(self, knob_module, fmt="knob {} {}", **kwargs):
+        super().__init__(**kwargs)
+        self.knob_module = knob_module
+        self.fmt = fmt
+        self.shown = None
+
+    def update(self, keyboard):
+        knob = self.knob_module.last_knob
+        if knob is None:
+            return False
+        value = self.knob_module.knob_values.get(knob, 0)
+        if (knob, value) == self.shown:
+            return False
+        self.shown = (knob, value)
+        self.text = self.fmt.format(knob, value)
+        return True
+
+
+class SliderBarsWidget(BarsEntry):
+    """A bar per slider, in MIDI index order. Sliders past count aren't shown."""
+
+    def __init__(self, slider_module, max_value=1023, **kwargs):
+        super().__init__(max_value=max_value, **kwargs)
+        self.slider_module = slider_module
+
+    def update(self, keyboard):
+        values = self.values
+        changed = False
+        for device in self.slider_module.devices.values():
+            for idx in range(device.num_sliders):
+                bar = self.slider_module.get_midi_index(device, idx)
+                if bar < self.count and values[bar] != device.slider_values[idx]:
+                    values[bar] = device.slider_values[idx]
+                    changed = True
+        return changed
+
+
+class ModuleCountWidget(TextEntry):
+    """How many modules are connected"""
+
+    def __init__(self, twiman, fmt="{} mods", **kwargs):
+        super().__init__(**kwargs)
+        self.twiman = twiman
+        self.fmt = fmt
+        self.shown = None
+
+    def update(self, keyboard):
+        count = len(self.twiman.registered_devices)
+        if count == self.shown:
+            return False
+        self.shown = count
+        self.text = self.fmt.format(count)
+        return True
@@ -2,12 +2,14 @@ from supervisor import ticks_ms
 
 import displayio
 import terminalio
+import vectorio
 from adafruit_display_text import label
 
 from kmk.extensions import Extension
 from kmk.keys import make_key
 from kmk.kmktime import PeriodicTimer, ticks_diff
 from kmk.modules.split import Split, SplitSide
+from kmk.scheduler import create_task
 from kmk.utils import clamp
 
 
@@ -72,6 +74,42 @@ class ImageEntry:
             self.side = SplitSide.RIGHT
 
 
+class BarsEntry:
+    """A row of vertical bars, 0 to max_value. Set values[i] from a widget's
+    update and return True to move them."""
+
+    def __init__(
+        self,
+        x=0,
+        y=0,
+        width=32,
+        height=16,
+        count=4,
+        max_value=127,
+        gap=1,
+        layer=None,
+        side=None,
+    ):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.count = count
+        self.max_value = max_value
+        self.gap = gap
+        self.values = [0] * count
+        self.bar_width = max(1, (width - gap * (count - 1)) // count)
+        self.layer = layer
+        self.side = side
+        if side == "L":
+            self.side = SplitSide.LEFT
+        if side == "R":
+            self.side = SplitSide.RIGHT
+
+    def bar_height(self, idx):
+        return clamp(self.values[idx] * self.height // self.max_value, 0, self.height)
+
+
 class DisplayBase:
     def __init__(self):
         raise NotImplementedError
@@ -105,6 +143,18 @@ class DisplayBase:
     def root_group(self, group):
         self.display.root_group = group
 
+    @property
+    def auto_refresh(self):
+        return self.display.auto_refresh
+
+    @auto_refresh.setter
+    def auto_refresh(self, auto_refresh):
+        self.display.auto_refresh = auto_refresh
+
+    def refresh(self):
+        # push the dirty areas now, no frame rate limiting
+        return self.display.refresh(target_frames_per_second=None)
+
 
 class Display(Extension):
     def __init__(
@@ -124,6 +174,9 @@ class Display(Extension):
         powersave_dim_time=10,
         powersave_dim_target=0.1,
         powersave_off_time=30,
+        max_fps=10,
+        refresh_budget=2,
+        page_height=8,
     ):
         self.display = display
         self.flip = flip
@@ -144,41 +197,192 @@ class Display(Extension):
         self.powersave_dim_target = powersave_dim_target
         self.powersave_off_time_ms = powersave_off_time * 1000
         self.dim_period = PeriodicTimer(50)
+        # renders and widget updates are coalesced into at most max_fps per second
+        self.max_fps = max_fps
+        self.widgets = []
+        # a frame is pushed a page (SSD1306: 8 rows) at a time from a scheduler task,
+        # spending at most refresh_budget ms per main loop cycle
+        self.refresh_budget_ms = refresh_budget
+        self.page_ms = (
+            0  # how long the last page took. a page only starts if it fits the budget
+        )
+        self.page_height = page_height
+        self.pages = []  # page -> indices of the entries starting on it
+        self.next_page = None  # page to render next, None when no frame is going
+        self.refresh_task = None
+        self.keyboard = None
         self.split_side = None
+        self.root = None
+        self.nodes = []
+        self.dirty = False
 
         make_key(names=("DIS_BRI",), on_press=self.display_brightness_increase)
         make_key(names=("DIS_BRD",), on_press=self.display_brightness_decrease)
 
-    def render(self, layer):
-        splash = displayio.Group()
+    def build(self):
+        # Retained mode: every entry gets its label / tile grid once, and the
+        # group is handed to the display once. After that only the properties
+        # that changed are touched, so displayio only refreshes dirty areas.
+        self.root = displayio.Group()
+        self.nodes = []
 
         for entry in self.entries:
-            if entry.layer != layer and entry.layer is not None:
-                continue
             if isinstance(entry, TextEntry):
-                splash.append(
-                    label.Label(
-                        terminalio.FONT,
-                        text=entry.text,
-                        color=entry.color,
-                        background_color=entry.background_color,
-                        anchor_point=entry.anchor_point,
-                        anchored_position=entry.anchored_position,
-                        label_direction=entry.direction,
-                        line_spacing=entry.line_spacing,
-                        padding_left=1,
-                    )
+                node = label.Label(
+                    terminalio.FONT,
+                    text=entry.text,
+                    color=entry.color,
+                    background_color=entry.background_color,
+                    anchor_point=entry.anchor_point,
+                    anchored_position=entry.anchored_position,
+                    label_direction=entry.direction,
+                    line_spacing=entry.line_spacing,
+                    padding_left=1,
                 )
             elif isinstance(entry, ImageEntry):
-                splash.append(
-                    displayio.TileGrid(
-                        entry.image,
-                        pixel_shader=entry.image.pixel_shader,
-                        x=entry.x,
-                        y=entry.y,
-                    )
+                node = displayio.TileGrid(
+                    entry.image,
+                    pixel_shader=entry.image.pixel_shader,
+                    x=entry.x,
+                    y=entry.y,
                 )
-        self.display.root_group = splash
+            elif isinstance(entry, BarsEntry):
+                node = displayio.Group(x=entry.x, y=entry.y)
+                palette = displayio.Palette(1)
+                palette[0] = 0xFFFFFF
+                for idx in range(entry.count):
+                    # vectorio shapes can't be 0 high, empty bars are 1 px
+                    node.append(
+                        vectorio.Rectangle(
+                            pixel_shader=palette,
+                            width=entry.bar_width,
+                            height=1,
+                            x=idx * (entry.bar_width + entry.gap),
+                            y=entry.height - 1,
+                        )
+                    )
+            else:
+                node = None
+
+            # widgets are entries that know how to update themselves
+            if hasattr(entry, "update"):
+                self.widgets.append(entry)
+
+            if node is not None:
+                node.hidden = True
+                self.root.append(node)
+            self.nodes.append(node)
+
+        self.pages = [[] for _ in range(max(1, self.height // self.page_height))]
+        for idx, node in enumerate(self.nodes):
+            if node is None:
+                continue
+            top = node.y
+            if isinstance(node, label.Label):
+                top += node.bounding_box[1]
+            page = clamp(top // self.page_height, 0, len(self.pages) - 1)
+            self.pages[page].append(idx)
+
+        self.display.root_group = self.root
+
+    def render_entry(self, idx, layer):
+        entry = self.entries[idx]
+        node = self.nodes[idx]
+        if node is None:
+            return
+
+        hidden = entry.layer != layer and entry.layer is not None
+        if node.hidden != hidden:
+            node.hidden = hidden
+        if hidden:
+            return
+
+        if isinstance(entry, TextEntry):
+            if node.text != entry.text:
+                node.text = entry.text
+            if node.anchored_position != entry.anchored_position:
+                node.anchored_position = entry.anchored_position
+        elif isinstance(entry, ImageEntry):
+            if node.x != entry.x:
+                node.x = entry.x
+            if node.y != entry.y:
+                node.y = entry.y
+        elif isinstance(entry, BarsEntry):
+            for bar_idx, bar in enumerate(node):
+                height = max(1, entry.bar_height(bar_idx))
+                if bar.height != height:
+                    bar.height = height
+                    bar.y = entry.height - height
+
+    def schedule_refresh(self):
+        # 1 ms, so the matrix gets scanned in between
+        if self.refresh_task is None:
+            self.refresh_task = create_task(self.refresh_step, after_ms=1)
+        else:
+            create_task(self.refresh_task, after_ms=1)
+
+    def start_frame(self):
+        # Periodic task. Updates the widgets, and if anything changed, starts
+        # pushing the frame page by page.
+        if self.next_page is not None:
+            return  # still busy with the last one
+
+        for widget in self.widgets:
+            if widget.update(self.keyboard):
+                self.dirty = True
+        layer = self.keyboard.active_layers[0]
+        if layer == self.prev_layer and not self.dirty:
+            return
+
+        self.prev_layer = layer
+        self.dirty = False
+        self.next_page = 0
+        self.schedule_refresh()
+
+    def keys_waiting(self):
+        # anything the main loop still has to turn into a report: a report,
+        # events it hasn't handled yet, events still sitting in a scanner.
+        keyboard = self.keyboard
+        if (
+            keyboard.hid_pending
+            or keyboard.matrix_update_queue
+            or keyboard._resume_buffer
+        ):
+            return True
+        for matrix in keyboard.matrix:
+            if matrix.events_pending:
+                return True
+        return False
+
+    def refresh_step(self):
+        # The OLED shares the bus with the modules. Keys that are waiting go
+        # first, and a page only starts if it fits in what's left of the
+        # budget for this cycle (the first one always does).
+        start = ticks_ms()
+        rendered = False
+        while self.next_page < len(self.pages):
+            if self.keys_waiting():
+                break
+            page = self.pages[self.next_page]
+            if not page:
+                self.next_page += 1
+                continue
+            elapsed = ticks_diff(ticks_ms(), start)
+            if rendered and elapsed + self.page_ms > self.refresh_budget_ms:
+                break
+
+            self.next_page += 1
+            page_start = ticks_ms()
+            for idx in page:
+                self.render_entry(idx, self.prev_layer)
+            self.display.refresh()
+            self.page_ms = ticks_diff(ticks_ms(), page_start)
+            rendered = True
+
+        if self.next_page < len(self.pages):
+            self.schedule_refresh()
+        else:
+            self.next_page = None
 
     def on_runtime_enable(self, sandbox):
         return
@@ -202,13 +406,15 @@ class Display(Extension):
 
         self.display.during_bootup(self.width, self.height, 180 if self.flip else 0)
         self.display.brightness = self.brightness
+        # refreshes are driven by start_frame / refresh_step, not by displayio
+        self.display.auto_refresh = False
+        self.keyboard = keyboard
+        self.build()
+        create_task(self.start_frame, period_ms=1000 // self.max_fps)
 
     def before_matrix_scan(self, sandbox):
         if self.dim_period.tick():
             self.dim()
-        if sandbox.active_layers[0] != self.prev_layer:
-            self.prev_layer = sandbox.active_layers[0]
-            self.render(sandbox.active_layers[0])
 
     def after_matrix_scan(self, sandbox):
         if sandbox.matrix_update or sandbox.secondary_matrix_update:
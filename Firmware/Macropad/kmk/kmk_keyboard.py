@@ -3,7 +3,7 @@ try:
 except ImportError:
     pass
 
-from collections import namedtuple
+from collections import deque, namedtuple
 from keypad import Event as KeyEvent
 
 from kmk.hid import BLEHID, USBHID, AbstractHID, HIDModes
@@ -44,6 +44,10 @@ class KMKKeyboard:
         self.col_pins = None
         self.diode_orientation = None
         self.matrix = None
+        # matrix events handled per main loop cycle. with more than 1 the scanners are drained
+        # instead of read once, so a burst of keys doesn't trickle in one cycle apart.
+        # the Split half that sends its keys over only forwards the first event, leave it at 1 there.
+        self.max_events_per_cycle = 1
 
         self.modules = []
         self.extensions = []
@@ -61,7 +65,10 @@ class KMKKeyboard:
         self.hid_pending = False
         self.matrix_update = None
         self.secondary_matrix_update = None
-        self.matrix_update_queue = []
+        # flag 1: a full deque raises instead of quietly dropping the oldest
+        # event, which could be a release. see _queue_matrix_update
+        self.matrix_update_queue = deque((), 128, 1)
+        self._matrix_updates = []
         self._trigger_powersave_enable = False
         self._trigger_powersave_disable = False
         self._go_args = None
@@ -480,6 +487,60 @@ class KMKKeyboard:
             gc.collect()
             debug("mem_info used:", gc.mem_alloc(), " free:", gc.mem_free())
 
+    def _drain_matrix(self) -> None:
+        # read every scanner until it's empty, as long as the cycle has room.
+        # the first event is matrix_update like always, modules see that one.
+        budget = self.max_events_per_cycle - len(self.matrix_update_queue)
+        for matrix in self.matrix:
+            while budget > 0:
+                update = matrix.scan_for_changes()
+                if not update:
+                    break
+                if self.matrix_update is None:
+                    self.matrix_update = update
+                else:
+                    self._matrix_updates.append(update)
+                budget -= 1
+
+    def _queue_matrix_update(self, kevent: KeyEvent) -> None:
+        try:
+            self.matrix_update_queue.append(kevent)
+        except IndexError:
+            # full. handle what's queued right away to make room, nothing gets lost.
+            # buffered keys first, they're older than anything in the queue
+            self._process_resume_buffer()
+            self._process_matrix_queue()
+            self._flush_hid()
+            self.matrix_update_queue.append(kevent)
+
+    def _process_matrix_queue(self) -> None:
+        queue = self.matrix_update_queue
+        last_pressed = None
+        for _ in range(min(len(queue), self.max_events_per_cycle)):
+            # a module buffered keys (HoldTap resolving...). they're resumed next
+            # cycle and have to come before the rest, so the rest waits.
+            if self._resume_buffer:
+                break
+            kevent = queue.popleft()
+            # presses in a row share a report (chords), so do releases in a row.
+            # when it flips, the report goes out first or a tap within one cycle never reaches the host.
+            if (
+                self.hid_pending
+                and last_pressed is not None
+                and kevent.pressed != last_pressed
+            ):
+                self._flush_hid()
+            last_pressed = kevent.pressed
+            self._handle_matrix_report(kevent)
+
+    def _flush_hid(self) -> None:
+        # a report in the middle of a cycle. it goes through the hooks like any
+        # other, Split needs them to keep the other half quiet.
+        self.before_hid_send()
+        if self.hid_pending:
+            self._send_hid()
+        self.after_hid_send()
+
     def _main_loop(self) -> None:
         self.sandbox.active_layers = self.active_layers.copy()
 
@@ -487,27 +548,34 @@ class KMKKeyboard:
 
         self._process_resume_buffer()
 
-        for matrix in self.matrix:
-            update = matrix.scan_for_changes()
-            if update:
-                self.matrix_update = update
-                break
+        if self.max_events_per_cycle > 1:
+            self._drain_matrix()
+        else:
+            for matrix in self.matrix:
+                update = matrix.scan_for_changes()
+                if update:
+                    self.matrix_update = update
+                    break
         self.sandbox.matrix_update = self.matrix_update
         self.sandbox.secondary_matrix_update = self.secondary_matrix_update
 
         self.after_matrix_scan()
 
         if self.secondary_matrix_update:
-            self.matrix_update_queue.append(self.secondary_matrix_update)
+            self._queue_matrix_update(self.secondary_matrix_update)
             self.secondary_matrix_update = None
 
         if self.matrix_update:
-            self.matrix_update_queue.append(self.matrix_update)
+            self._queue_matrix_update(self.matrix_update)
             self.matrix_update = None
 
-        # only handle one key per cycle.
-        if self.matrix_update_queue:
-            self._handle_matrix_report(self.matrix_update_queue.pop(0))
+        if self._matrix_updates:
+            for update in self._matrix_updates:
+                self._queue_matrix_update(update)
+            self._matrix_updates.clear()
+
+        # only handle max_events_per_cycle keys per cycle.
+        self._process_matrix_queue()
 
         self.before_hid_send()
 
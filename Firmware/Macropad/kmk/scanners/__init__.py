@@ -29,6 +29,13 @@ class Scanner:
     def key_count(self):
         raise NotImplementedError
 
+    @property
+    def events_pending(self):
+        """
+        True if there are events that scan_for_changes hasn't returned yet.
+        """
+        return False
+
     def scan_for_changes(self):
         """
         Scan for key events and return a key report if an event exists.
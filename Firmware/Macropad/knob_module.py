@@ -1,19 +1,24 @@
-from sched import scheduler
 import struct
-from time import time
+from supervisor import ticks_ms
 from base_module import BaseModule, ModuleType
+from kmk import scheduler
+from kmk.keys import KC, Axis
+from kmk.kmktime import ticks_diff
+from twi_scanner import BUTTON, CCW, CW
 from twiman import TWIDevice
 
 
 class KnobDevice(TWIDevice):
     """An extension of TWIDevice for knob devices"""
 
-    def __init__(self, addr, channel, serial_id):
-        super().__init__(addr, channel, serial_id)
+    def __init__(self, addr, channel, raw_friend_code):
+        super().__init__(addr, channel, raw_friend_code)
         self.num_encoders = 0
+        self.frame_format = None
         self.rotation_delta = []
         self.button_pressed = []
         self.button_released = []
+        self.button_down = []  # what we last told the keyboard
 
 
 # Should even be more refreshed frequently to ensure extra "responsiveness"
@@ -24,31 +29,79 @@ class KnobModule(BaseModule):
         super().__init__(twiman, ModuleType.KNOBS)
         self.global_encoder_count = 0
         self.knob_lookup = {}  # super shitty way to do this
-        self.update_interval = 50  # ms
+        self.poll_fast_ms = 5  # knobs want to feel snappy
+        self.poll_idle_ms = 100
 
         self.map = None
 
+        # for the display. the last knob that was turned and where every knob is at (sum of its deltas)
+        self.last_knob = None
+        self.knob_values = {}  # knob index -> value
+
+        # acceleration: (detents per second, multiplier) pairs, ascending. the last one reached wins.
+        # ((0, 1),) turns it off
+        self.acceleration = ((0, 1), (20, 2), (50, 4))
+        self.last_rotation = {}  # knob index -> ticks of its last rotation
+
+        # key taps don't all go out at once (they'd all end up in the same report and count as one),
+        # they're queued per knob and played back one tap per knob every tap_interval ms.
+        # the queue is capped, so a wild spin can't keep the volume going for seconds after the knob stopped.
+        self.tap_interval = 10  # ms. press and release each get half
+        self.max_backlog = 8  # taps per knob
+        self.backlog = {}  # knob index -> [key, taps left]
+        self.held_keys = []  # pressed by the last tap, released on the next run
+        self.tap_task = None
+        self.tapping = False
+
+        # a TWIScanner that's also in keyboard.matrix. the knobs' keys go through it like matrix keys,
+        # map[layer][knob] is put in the keymap for them at bootup. so HoldTap, Layers, Combos... all work.
+        # without one, rotations are tapped straight into the report and buttons go through the modules
+        # with the map[layer][knob][2] of the layer they were pressed on
+        self.scanner = None
+        self.pressed_buttons = {}  # knob index -> key it pressed. no scanner only
+
     def twiman_new_device_callback(self, device):
-        if device.type_id == self.target_type_id:  # ?????
-            friend_code = device.get_friend_code()
-            knob_device = KnobDevice(device.addr, device.channel, device.raw_serial)
+        friend_code = device.get_friend_code()
+        knob_device = KnobDevice(device.addr, device.channel, device.raw_friend_code)
+        knob_device.descriptor = device.descriptor
+        encoder_count = self.get_known_count(knob_device)
+        if encoder_count is None:
             encoder_count = self.get_encoder_count(knob_device)
+            self.remember_count(knob_device, encoder_count)
 
-            knob_device.num_encoders = encoder_count
-            # set initial values to 0. I do not know if this can be in the constructor.
-            knob_device.rotation_delta = [0] * encoder_count
-            knob_device.button_pressed = [0] * encoder_count
-            knob_device.button_released = [0] * encoder_count
-
-            # key = (slider_device.addr, slider_device.channel, friend_code)
-            self.knob_lookup[friend_code] = encoder_count
-            self.global_encoder_count += encoder_count
+        knob_device.frame_format = self.get_frame_format(knob_device, encoder_count)
+        if knob_device.frame_format is None:
+            return
 
-            self.devices.append(knob_device)
-            print(f"new knob device detected: {friend_code}")
+        knob_device.num_encoders = encoder_count
+        # set initial values to 0. I do not know if this can be in the constructor.
+        knob_device.rotation_delta = [0] * encoder_count
+        knob_device.button_pressed = [0] * encoder_count
+        knob_device.button_released = [0] * encoder_count
+        knob_device.button_down = [False] * encoder_count
+        knob_device.poll_command = bytes([0x01, 0x01])  # knobs cmd, get changes
+        if self.has_dirty_byte(knob_device):
+            knob_device.dirty_command = bytes([0x01, 0x04])  # knobs cmd, get dirty
+        knob_device.rx_buffer = bytearray(struct.calcsize(knob_device.frame_format))
+
+        # key = (slider_device.addr, slider_device.channel, friend_code)
+        self.knob_lookup[friend_code] = encoder_count
+        self.global_encoder_count += encoder_count
+
+        self.add_device(knob_device)
+        self.twiman.add_polled_device(knob_device, self)
+        print(f"new knob device detected: {friend_code}")
 
     def twiman_removed_device_callback(self, device):
-        if device in self.devices:
+        ours = self.devices.get((device.channel, device.addr))
+        if ours is not None:
+            # don't leave keys stuck down. has to happen before pop_device changes the indices
+            for idx in range(ours.num_encoders):
+                if ours.button_down[idx]:
+                    ours.button_down[idx] = False
+                    self.button_event(self.get_knob_index(ours, idx), False)
+
+        if self.pop_device(device) is not None:
             friend_code = device.get_friend_code()
             # key = (device.addr, device.channel, friend_code)
             num_encoders = self.knob_lookup.pop(friend_code, None)
@@ -59,120 +112,227 @@ class KnobModule(BaseModule):
             else:
                 print(f"knob device removed: {friend_code} (unknown encoder count)")
 
-            self.devices.remove(device)
             print(f"knob device removed: {device.get_friend_code()}")
 
-    def get_encoder_count(self, device: KnobDevice):
-        """Return the number of encoders in a device"""
-        self.twiman.select_channel(device.channel)
-
-        command = bytes([0x02, 0x03])
-        buffer = bytearray(1)
-        self.twiman.send_command(device.addr, command)
-        time.sleep(0.005)  # 5 ms
-        self.twiman.read_from_device(device.addr, buffer)
-
-        return buffer[0]
-
-    def get_encoder_values(
-        self, device: KnobDevice
-    ) -> tuple[list[int], list[int], list[int]]:
-        """Get the slider values from a device"""
-        self.twiman.select_channel(device.channel)
-        num_encoders = device.num_encoders
-        total_bytes = num_encoders * 3  # int8 + uint8 + uint8
-
-        buf = bytearray(total_bytes)
-        self.twiman.readfrom_into(device.addr, buf)
-
+    def build_frame_format(self, count: int):
         # struct KnobChanges
         # {
         #   int8_t rotation_delta[NUM_ENCODERS];
         #   uint8_t button_pressed[NUM_ENCODERS];
         #   uint8_t button_released[NUM_ENCODERS];
         # };
+        return f"<{count}b{count}B{count}B"
 
-        format = f"<{num_encoders}b{num_encoders}B{num_encoders}B"
-        unpacked = struct.unpack(format, buf)
-        rotation_delta = list(unpacked[:num_encoders])
-        button_pressed = list(unpacked[num_encoders : 2 * num_encoders])
-        button_released = list(unpacked[2 * num_encoders :])
+    def get_encoder_count(self, device: KnobDevice):
+        """Return the number of encoders in a device. Only used for firmware without a descriptor."""
+        buffer = bytearray(1)
+        command = bytes([0x01, 0x03])  # knobs cmd, get encoder number
+        with self.twiman.bus:
+            self.twiman.select_channel(device.channel)
+            if not self.twiman.request(device, command, buffer):
+                return 0
 
-        return (
-            rotation_delta,
-            button_pressed,
-            button_released,  # ignored for now
-        )
+        return buffer[0]
+
+    def decode_frame(self, device: KnobDevice):
+        """Decode the last frame the poll pass read from a device into its lists, in place.
+        The poll path runs every few ms, so this allocates nothing (no GC pauses, no keystroke jitter)."""
+        # the layout is device.frame_format, KnobChanges. decoded by hand because unpack makes new tuples
+        buf = device.rx_buffer
+        num_encoders = device.num_encoders
+        rotation_delta = device.rotation_delta
+        button_pressed = device.button_pressed
+        button_released = device.button_released
+
+        for idx in range(num_encoders):
+            delta = buf[idx]
+            rotation_delta[idx] = delta - 256 if delta > 127 else delta  # int8
+            button_pressed[idx] = buf[num_encoders + idx]
+            button_released[idx] = buf[2 * num_encoders + idx]
+
+    def control_count(self, device: KnobDevice):
+        return device.num_encoders
 
     def get_knob_index(self, device: KnobDevice, encoder_idx: int):
-        """A stable index for our KNOBS. When a device is removed the index will change, otherwise it will not."""  # :)
-        knob_index = 0
-        for d in self.devices:
-            if d == device:
-                break
-            knob_index += d.num_encoders
-        return knob_index + encoder_idx
+        """A stable index for our KNOBS. When a device is removed the index will change, otherwise it will not.
+        Set pin_controls to keep the index of replugged devices."""  # :)
+        return self.get_control_index(device, encoder_idx)
 
     def handle_encoder_rotation(self, device: KnobDevice, encoder_idx: int, delta: int):
         """Handle the rotation of the encoder"""
-        if not self.map:
-            return
-        layer_id = self.keyboard.active_layer[0]
-
         encoder_index = self.get_knob_index(device, encoder_idx)
+        self.last_knob = encoder_index
+        self.knob_values[encoder_index] = self.knob_values.get(encoder_index, 0) + delta
+
+        steps = self.accelerate(encoder_index, abs(delta))
+        direction = CCW if delta < 0 else CW
+
+        if self.scanner is not None:
+            # taps are key numbers, the keymap decides what they are, layers falling through and all
+            tap = self.scanner.key_number(encoder_index, direction)
+            if tap is None:
+                return
+            direction_key = self.keyboard._find_key_in_map(self.scanner.offset + tap)
+        else:
+            tap = direction_key = self.mapped_key(encoder_index, direction)
+            if tap is None:
+                return  # nothing mapped to it. the rest of the frame still gets handled
+
+        if isinstance(direction_key, Axis):
+            # relative axes (AX.W, the mouse wheel...) take the whole turn in one report.
+            # the CW slot moves it forward, the CCW slot backwards
+            direction_key.move(self.keyboard, -steps if delta < 0 else steps)
+            return
 
-        encoder_mapping = self.map[layer_id][encoder_index]
-
-        steps = abs(delta)
-        direction_key = (
-            encoder_mapping[0] if delta < 0 else encoder_mapping[1]  # CCW : CW
-        )
-
-        for _ in range(steps):
-            self.keyboard.tap_key(direction_key)
-
-        print(
-            f"encoder {encoder_idx} ({device.get_friend_code()}) rotated: {delta} steps"
-        )
+        self.queue_taps(encoder_index, tap, steps)
 
-    def handle_encoder_pressed(self, device: KnobDevice, encoder_idx: int):
-        """Handle the button press of the encoder"""
+    def mapped_key(self, knob: int, slot: int):
+        """map[active layer][knob][slot], or None if there's nothing there"""
         if not self.map:
+            return None
+        layer_id = self.keyboard.active_layers[0]
+        if layer_id >= len(self.map) or knob >= len(self.map[layer_id]):
+            return None
+        return self.map[layer_id][knob][slot]
+
+    def accelerate(self, knob: int, steps: int):
+        """Scale the steps of a rotation by how fast the knob is turning"""
+        now = ticks_ms()
+        last = self.last_rotation.get(knob)
+        self.last_rotation[knob] = now
+        if last is None:
+            return steps
+
+        speed = steps * 1000 // max(1, ticks_diff(now, last))  # detents per second
+        multiplier = 1
+        for threshold, factor in self.acceleration:
+            if speed >= threshold:
+                multiplier = factor
+        return steps * multiplier
+
+    def queue_taps(self, knob: int, key, taps: int):
+        """Queue taps of key (a key number with a scanner) for a knob.
+        Turning the other way drops what was left of the old direction."""
+        entry = self.backlog.get(knob)
+        if entry is None or entry[0] != key:
+            entry = self.backlog[knob] = [key, 0]
+        entry[1] = min(self.max_backlog, entry[1] + taps)
+
+        if not self.tapping:
+            self.tapping = True
+            self.schedule_taps(1)
+
+    def schedule_taps(self, after_ms):
+        # the same task every time, no lambda per tap
+        if self.tap_task is None:
+            self.tap_task = scheduler.create_task(self.run_taps, after_ms=after_ms)
+        else:
+            scheduler.create_task(self.tap_task, after_ms=after_ms)
+
+    def run_taps(self):
+        """Release what the last run pressed, or press the next tap of every knob with a backlog"""
+        if self.held_keys:
+            for key in self.held_keys:
+                self.tap_event(key, False)
+            self.held_keys.clear()
+            self.schedule_taps(max(1, self.tap_interval // 2))
             return
-        layer_id = self.keyboard.active_layer[0]
 
-        encoder_index = self.get_knob_index(device, encoder_idx)
-
-        encoder_mapping = self.map[layer_id][encoder_index]
-        button_key = encoder_mapping[2]  # button is index 2 (last one)
-        self.keyboard.tap_key(button_key)
-
-        print(f"encoder {encoder_idx} ({device.get_friend_code()}) pressed")
-
-    def update_knobs(self):
-        """Update all knobs"""
-        for device in self.devices:
-            rotation_delta, button_pressed, button_released = self.get_encoder_values(
-                device
-            )
-            device.rotation_delta = rotation_delta
-            device.button_pressed = button_pressed
-            device.button_released = button_released
-
-            print(f"knob values: {rotation_delta}")
-            print(f"knob pressed: {button_pressed}")
-            print(f"knob released: {button_released}")
-
-            for idx in range(device.num_encoders):
-                current_delta = device.rotation_delta[idx]
-                if rotation_delta != 0:
-                    self.handle_encoder_rotation(device, idx, current_delta)
-                if device.button_pressed[idx]:
-                    self.handle_encoder_pressed(device, idx)
-
-    def schedule_tasks(self):
-        """Schedule the knob update task"""
-        scheduler.create_task(self.update_knobs, period_ms=self.update_interval)
+        for knob in list(self.backlog):
+            entry = self.backlog[knob]
+            if entry[1] <= 0:
+                del self.backlog[knob]
+                continue
+            entry[1] -= 1
+            self.tap_event(entry[0], True)
+            self.held_keys.append(entry[0])
+
+        if self.held_keys:
+            self.schedule_taps(max(1, self.tap_interval - self.tap_interval // 2))
+        else:
+            self.tapping = False
+
+    def tap_event(self, key, is_pressed: bool):
+        if self.scanner is not None:
+            self.scanner.push(key, is_pressed)
+        elif is_pressed:
+            self.keyboard.add_key(key)
+        else:
+            self.keyboard.remove_key(key)
 
     def mod_during_bootup(self, keyboard):
-        self.schedule_tasks()
+        if self.map and self.scanner is not None:
+            self.install_keys(keyboard)
+
+    def install_keys(self, keyboard):
+        """Put map[layer][knob] (CCW, CW, button) in the keymap at the scanner's keys"""
+        scanner = self.scanner
+        coord_mapping = keyboard.coord_mapping
+        size = len(coord_mapping)
+
+        for layer_idx, layer in enumerate(keyboard.keymap):
+            keys = list(layer[:size])
+            keys.extend([KC.TRNS] * (size - len(keys)))
+            knobs = self.map[layer_idx] if layer_idx < len(self.map) else []
+            for knob in range(min(len(knobs), scanner.knobs)):
+                for slot in (CCW, CW, BUTTON):
+                    int_coord = scanner.offset + scanner.key_number(knob, slot)
+                    if int_coord in coord_mapping:
+                        keys[coord_mapping.index(int_coord)] = knobs[knob][slot]
+            keyboard.keymap[layer_idx] = keys
+
+    def handle_encoder_button(
+        self, device: KnobDevice, encoder_idx: int, pressed: bool, released: bool
+    ):
+        """Turn the pressed / released flags of a frame into key events, in the order they must have happened"""
+        knob = self.get_knob_index(device, encoder_idx)
+        down = device.button_down[encoder_idx]
+        if released and down:
+            self.button_event(knob, False)
+            down = False
+        if pressed:
+            self.button_event(knob, True)
+            down = True
+            if released and not device.button_down[encoder_idx]:
+                # pressed and let go between two polls
+                self.button_event(knob, False)
+                down = False
+        device.button_down[encoder_idx] = down
+
+    def button_event(self, knob: int, is_pressed: bool):
+        """Hand a knob button to the scanner, the main loop takes it from there.
+        Without one it goes into the keyboard right away, like a key without a coord."""
+        if self.scanner is not None:
+            key_number = self.scanner.key_number(knob, BUTTON)
+            if key_number is not None:
+                self.scanner.push(key_number, is_pressed)
+            return
+
+        if is_pressed:
+            key = self.mapped_key(knob, BUTTON)
+            if key is None:
+                return
+            self.pressed_buttons[knob] = key
+        else:
+            # the key it pressed, even if the layer changed since
+            key = self.pressed_buttons.pop(knob, None)
+            if key is None:
+                return
+        self.keyboard.pre_process_key(key, is_pressed)
+
+    def handle_frame(self, device: KnobDevice):
+        """Handle the changes of a knob device. Called by the TWIManager poll pass."""
+        self.decode_frame(device)
+
+        active = False
+        for idx in range(device.num_encoders):
+            current_delta = device.rotation_delta[idx]
+            if current_delta != 0:
+                active = True
+                self.handle_encoder_rotation(device, idx, current_delta)
+            pressed = device.button_pressed[idx]
+            released = device.button_released[idx]
+            if pressed or released:
+                active = True
+                self.handle_encoder_button(device, idx, pressed, released)
+        return active
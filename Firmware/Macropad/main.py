@@ -1,13 +1,22 @@
 import board
 import digitalio
 
+from display_widgets import (
+    KnobWidget,
+    LayerWidget,
+    ModuleCountWidget,
+    SliderBarsWidget,
+)
 from kmk.extensions.display import Display, TextEntry, ssd1306
 from kmk.extensions.media_keys import MediaKeys
 from kmk.kmk_keyboard import KMKKeyboard
 from kmk.keys import KC
 from kmk.scanners import DiodeOrientation
+from kmk.scanners.keypad import MatrixScanner
 from knob_module import KnobModule
+from module_registry import ModuleRegistry
 from slider_module import SliderModule
+from twi_scanner import TWIScanner
 from twiman import TWIManager
 
 mux_reset = digitalio.DigitalInOut(board.D10)  # unused
@@ -16,8 +25,11 @@ mux_reset.value = True  # required or else the mux will be stuck in reset.
 
 keyboard = KMKKeyboard()  # keyboard updates first
 twiman = TWIManager(
-    mux_channels=4 - 1
-)  # There's 4 channels. One is used for the display, so we have 3 left for devices.
+    # There's 4 channels. One is used for the display, so we have 3 left for devices.
+    mux_channels=4 - 1,
+    # modules keep their knob/MIDI slots and addresses between boots
+    registry=ModuleRegistry(),
+)
 
 twiman.initial_discovery()
 twiman.schedule_tasks()
@@ -45,29 +57,41 @@ display = Display(
     powersave_off_time=30,  # time in seconds to turn off screen
 )
 
+slider_module = SliderModule(twiman)
+knob_module = KnobModule(twiman)
+# the knobs' keys come in through the matrix, in order with the real keys
+knob_module.scanner = TWIScanner(knobs=3)
+
 display.entries = [
-    TextEntry(text="tahnks yours kmk", x=0, y=0),
-    TextEntry(text="beep beep pad", x=0, y=12),
-    TextEntry(text="Hey there!", x=0, y=24),
+    TextEntry(text="beep beep pad", x=0, y=0),
+    ModuleCountWidget(twiman, x=127, y=0, x_anchor="R"),
+    LayerWidget(x=0, y=12),
+    KnobWidget(knob_module, x=0, y=24),
+    SliderBarsWidget(slider_module, x=80, y=12, width=47, height=20, count=8),
 ]
 keyboard.extensions.append(display)
 
-keyboard.col_pins = (
-    board.D6,
-    board.D8,
-    board.D7,
-)
-keyboard.row_pins = (
-    board.D1,
-    board.D3,
-    board.D9,
-)
-keyboard.diode_orientation = DiodeOrientation.COL2ROW
+keyboard.matrix = [
+    MatrixScanner(
+        column_pins=(
+            board.D6,
+            board.D8,
+            board.D7,
+        ),
+        row_pins=(
+            board.D1,
+            board.D3,
+            board.D9,
+        ),
+        columns_to_anodes=DiodeOrientation.COL2ROW,
+    ),
+    knob_module.scanner,
+]
+# the poll pass makes for long loop cycles. take every key that came in since the last one, not just one
+keyboard.max_events_per_cycle = 8
 media_keys = MediaKeys()
 keyboard.extensions.append(media_keys)
-keyboard.extensions.append(SliderModule(twiman))
-
-knob_module = KnobModule(twiman)
+keyboard.extensions.append(slider_module)
 keyboard.extensions.append(knob_module)
 
 keyboard.keymap = [
@@ -83,10 +107,13 @@ keyboard.keymap = [
     ]
 ]
 
+# layer -> knob -> (CCW, CW, button)
 knob_module.map = [
-    [KC.BRIGHTNESS_UP, KC.BRIGHTNESS_DOWN, KC.BRIGHTNESS_DOWN],
-    [KC.AUDIO_VOL_UP, KC.AUDIO_VOL_DOWN, KC.AUDIO_MUTE],
-    [KC.LCTRL(KC.EQUAL), KC.LCTRL(KC.MINUS), KC.NO],
+    [
+        [KC.BRIGHTNESS_UP, KC.BRIGHTNESS_DOWN, KC.BRIGHTNESS_DOWN],
+        [KC.AUDIO_VOL_UP, KC.AUDIO_VOL_DOWN, KC.AUDIO_MUTE],
+        [KC.LCTRL(KC.EQUAL), KC.LCTRL(KC.MINUS), KC.NO],
+    ]
 ]
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import usb_midi
+from kmk import scheduler
+
+# 120-127 aren't controllers, they're Channel Mode messages (All Notes Off, Reset All Controllers...)
+MAX_CONTROLLER = 119
+
+
+class MidiOutput:
+    """Collects MIDI Control Changes and writes them to usb_midi in one go.
+
+    CCs queued during a poll pass are flushed right after it, in one write. A controller that changes twice
+    before that only sends its last value. Every message is complete (status, controller, value): USB-MIDI
+    packs messages into 4 byte event packets and a data byte without its status gets a packet of its own,
+    so running status would only make it worse. The buffer is made once, so sending allocates nothing
+    but the slice handed to usb_midi.
+    """
+
+    def __init__(self, port=None, channel=0, max_messages=32):
+        self.port = usb_midi.ports[1] if port is None else port
+        self.channel = channel
+        self.max_messages = max_messages
+        # (status, controller, value) triples
+        self.buffer = bytearray(3 * max_messages)
+        self.view = memoryview(self.buffer)
+        self.pending = {}  # controller -> value. the latest value wins
+        self.order = []  # controllers in the order they were queued
+        self.flush_task = None
+        self.messages_sent = 0
+        self.messages_dropped = 0  # superseded before they were sent
+        self.messages_rejected = 0  # controllers past MAX_CONTROLLER
+
+    def control_change(self, controller: int, value: int):
+        """Queue a CC. Sent on the next flush, which runs right after the current scheduler task.
+        Returns False if there's no such controller."""
+        if not 0 <= controller <= MAX_CONTROLLER:
+            self.messages_rejected += 1
+            return False
+
+        if controller in self.pending:
+            self.messages_dropped += 1
+        else:
+            self.order.append(controller)
+        self.pending[controller] = value & 0x7F
+
+        if len(self.order) == 1:
+            self.schedule_flush()
+        return True
+
+    def schedule_flush(self):
+        # after_ms=0 puts it right behind the task that is running now (the poll pass)
+        if self.flush_task is None:
+            self.flush_task = scheduler.create_task(self.flush, after_ms=0)
+        else:
+            scheduler.create_task(self.flush_task, after_ms=0)
+
+    def flush(self):
+        """Write every queued CC"""
+        order = self.order
+        if not order:
+            return
+
+        buffer = self.buffer
+        pending = self.pending
+        status = 0xB0 | self.channel  # control change
+        length = 0
+        for controller in order:
+            if length + 3 > len(buffer):
+                self.write(length)
+                length = 0
+            buffer[length] = status
+            buffer[length + 1] = controller
+            buffer[length + 2] = pending[controller]
+            length += 3
+        self.write(length)
+
+        self.messages_sent += len(order)
+        order.clear()
+        pending.clear()
+
+    def write(self, length):
+        try:
+            self.port.write(self.view[:length])
+        except Exception as e:
+            print(f"failed to write MIDI: {e}")
@@ -0,0 +1,124 @@
+import json
+from supervisor import ticks_ms
+from kmk import scheduler
+from kmk.kmktime import ticks_diff
+
+
+class ModuleRegistry:
+    """Remembers modules between boots, keyed by friend code. Stores their control slots, counts and last address.
+
+    Lives on the CIRCUITPY drive, which is only writable from here when it isn't exposed over USB
+    (bootcfg(storage=False)) or it's remounted in boot.py. If it isn't, everything still works, just in RAM.
+    """
+
+    def __init__(
+        self,
+        path="/moonpad_modules.json",
+        flush_delay=10,
+        min_flush_interval=60,
+    ):
+        self.path = path
+        self.entries = {}  # friend code -> {"addr": [channel, addr], "slot": int, "count": int}
+        self.writable = True
+
+        # ! seconds ! flash doesn't like being written a lot, so changes are coalesced and written together
+        self.flush_delay_ms = flush_delay * 1000
+        self.min_flush_interval_ms = min_flush_interval * 1000
+        self.dirty = False
+        self.flush_scheduled = False
+        self.last_flush = None
+        self.last_written = None
+
+        self.load()
+
+    def load(self):
+        """Load the registry from the drive"""
+        try:
+            with open(self.path, "r") as f:
+                self.last_written = f.read()
+            self.entries = json.loads(self.last_written)
+            print(f"module registry: {len(self.entries)} known modules")
+        except OSError:
+            self.entries = {}  # first boot. nothing there yet
+        except ValueError as e:
+            print(f"module registry is broken, starting over: {e}")
+            self.entries = {}
+
+    def get(self, friend_code):
+        """Get what we know about a module, or None"""
+        return self.entries.get(friend_code)
+
+    def entries_for_type(self, type_id):
+        """All the known modules of a type"""
+        prefix = f"{type_id:02X}"
+        return [
+            (friend_code, entry)
+            for friend_code, entry in self.entries.items()
+            if friend_code.startswith(prefix)
+        ]
+
+    def update(self, friend_code, **fields):
+        """Update what we know about a module. Only schedules a write if something actually changed."""
+        entry = self.entries.get(friend_code)
+        if entry is None:
+            entry = self.entries[friend_code] = {}
+
+        changed = False
+        for key, value in fields.items():
+            if entry.get(key) != value:
+                entry[key] = value
+                changed = True
+
+        if changed:
+            self.mark_dirty()
+
+    def forget(self, friend_code, *fields):
+        """Drop fields of what we know about a module"""
+        entry = self.entries.get(friend_code)
+        if entry is None:
+            return
+        changed = False
+        for key in fields:
+            if entry.pop(key, None) is not None:
+                changed = True
+
+        if changed:
+            self.mark_dirty()
+
+    def mark_dirty(self):
+        self.dirty = True
+        if not self.flush_scheduled and self.writable:
+            self.flush_scheduled = True
+            scheduler.create_task(self.flush, after_ms=self.flush_delay_ms)
+
+    def flush(self):
+        """Write the registry to the drive, if it changed and the last write isn't too recent"""
+        self.flush_scheduled = False
+        if not self.dirty or not self.writable:
+            return
+
+        now = ticks_ms()
+        if self.last_flush is not None:
+            since_last = ticks_diff(now, self.last_flush)
+            if since_last < self.min_flush_interval_ms:
+                self.flush_scheduled = True
+                scheduler.create_task(
+                    self.flush, after_ms=self.min_flush_interval_ms - since_last
+                )
+                return
+
+        data = json.dumps(self.entries)
+        self.dirty = False
+        if data == self.last_written:
+            return  # same bytes as what's already there. don't wear the flash for nothing
+
+        try:
+            with open(self.path, "w") as f:
+                f.write(data)
+            self.last_written = data
+            self.last_flush = now
+            print(f"module registry: saved {len(self.entries)} modules")
+        except OSError as e:
+            # read-only drive. keep going without saving
+            print(f"module registry can't be saved: {e}")
+            self.writable = False
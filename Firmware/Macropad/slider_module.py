@@ -1,23 +1,21 @@
 import struct
-from time import time
 from base_module import BaseModule, ModuleType
-from kmk import scheduler
-from lib.Adafruit_CircuitPython_MIDI.adafruit_midi import MIDI
-from lib.Adafruit_CircuitPython_MIDI.adafruit_midi.control_change import ControlChange
-import usb_midi
+from midi_output import MAX_CONTROLLER, MidiOutput
 from twiman import TWIDevice
-from utils import map_value
 
 
 class SliderDevice(TWIDevice):
     """An extension of TWIDevice for slider devices"""
 
-    def __init__(self, addr, channel, serial_id):
-        super().__init__(addr, channel, serial_id)
+    def __init__(self, addr, channel, raw_friend_code):
+        super().__init__(addr, channel, raw_friend_code)
         self.num_sliders = 0
+        self.frame_format = None
         self.slider_values = []
-        self.old_slider_values = []
+        self.new_slider_values = []  # scratch space for decode_frame
+        self.old_slider_values = []  # after the hysteresis filter
         self.slider_changed = []
+        self.midi_values = []  # last values sent, 7 or 14 bit. -1 before the first one
 
 
 # Should be refreshed frequently to ensure "responsiveness"
@@ -28,31 +26,57 @@ class SliderModule(BaseModule):
         super().__init__(twiman, ModuleType.SLIDERS)
         self.global_slider_count = 0
         self.slider_lookup = {}  # super shitty way to do this
-        self.slider_deadzone = 5  # TODO: DOUBLE DEADZONE IN PYTHON AND CPP!!!!!!!
-        self.update_interval = 100  # ms
-
-        self.midi = MIDI(midi_out=usb_midi.ports[1], out_channel=0)
+        self.slider_max = 1023  # 10 bit ADC on the module
+        # jitter filter in slider units, see filter_value. the module firmware has its own (> 3) on top of it
+        self.slider_hysteresis = 4
+        # 14 bit CCs: MSB on cc n, LSB on cc n + 32. only the first 32 sliders can do it, the rest stay 7 bit
+        # and move up to cc 64 and on, out of the way of the LSBs
+        self.high_resolution = False
+        self.unmapped = (
+            set()
+        )  # midi indices past the last controller, already complained about
+        self.poll_fast_ms = 10
+        self.poll_idle_ms = 200
+
+        self.midi = MidiOutput(channel=0)
 
     def twiman_new_device_callback(self, device):
-        if device.type_id == self.target_type_id:  # ?????
-            friend_code = device.get_friend_code()
-            slider_device = SliderDevice(device.addr, device.channel, device.raw_serial)
+        friend_code = device.get_friend_code()
+        slider_device = SliderDevice(
+            device.addr, device.channel, device.raw_friend_code
+        )
+        slider_device.descriptor = device.descriptor
+        slider_count = self.get_known_count(slider_device)
+        if slider_count is None:
             slider_count = self.get_slider_count(slider_device)
-
-            slider_device.num_sliders = slider_count
-            # set initial values to 0. I do not know if this can be in the constructor.
-            slider_device.slider_values = [0] * slider_count
-            slider_device.old_slider_values = [0] * slider_count
-
-            # key = (slider_device.addr, slider_device.channel, friend_code)
-            self.slider_lookup[friend_code] = slider_count
-            self.global_slider_count += slider_count
-
-            self.devices.append(slider_device)
-            print(f"new slider device detected: {friend_code}")
+            self.remember_count(slider_device, slider_count)
+
+        slider_device.frame_format = self.get_frame_format(slider_device, slider_count)
+        if slider_device.frame_format is None:
+            return
+
+        slider_device.num_sliders = slider_count
+        # set initial values to 0. I do not know if this can be in the constructor.
+        slider_device.slider_values = [0] * slider_count
+        slider_device.new_slider_values = [0] * slider_count
+        slider_device.old_slider_values = [0] * slider_count
+        slider_device.midi_values = [-1] * slider_count
+        slider_device.slider_changed = [0] * slider_count
+        slider_device.poll_command = bytes([0x02, 0x01])  # sliders cmd, get changes
+        if self.has_dirty_byte(slider_device):
+            slider_device.dirty_command = bytes([0x02, 0x04])  # sliders cmd, get dirty
+        slider_device.rx_buffer = bytearray(struct.calcsize(slider_device.frame_format))
+
+        # key = (slider_device.addr, slider_device.channel, friend_code)
+        self.slider_lookup[friend_code] = slider_count
+        self.global_slider_count += slider_count
+
+        self.add_device(slider_device)
+        self.twiman.add_polled_device(slider_device, self)
+        print(f"new slider device detected: {friend_code}")
 
     def twiman_removed_device_callback(self, device):
-        if device in self.devices:
+        if self.pop_device(device) is not None:
             friend_code = device.get_friend_code()
             # key = (device.addr, device.channel, friend_code)
             num_sliders = self.slider_lookup.pop(friend_code, None)
@@ -63,84 +87,112 @@ class SliderModule(BaseModule):
             else:
                 print(f"slider device removed: {friend_code} (unknown slider count)")
 
-            self.devices.remove(device)
             print(f"slider device removed: {device.get_friend_code()}")
 
-    def get_slider_count(self, device: SliderDevice):
-        """Return the number of sliders in a device"""
-        self.twiman.select_channel(device.channel)
-
-        command = bytes([0x02, 0x03])
-        buffer = bytearray(1)
-        self.twiman.send_command(device.addr, command)
-        time.sleep(0.005)  # 5 ms
-        self.twiman.read_from_device(device.addr, buffer)
-
-        return buffer[0]
-
-    def get_slider_values(self, device: SliderDevice) -> tuple[list[int], list[int]]:
-        """Get the slider values from a device"""
-        self.twiman.select_channel(device.channel)
-        num_sliders = device.num_sliders
-        total_bytes = num_sliders * 2 + num_sliders * 1  # uint16 + uint8
-
-        buf = bytearray(total_bytes)
-        self.twiman.readfrom_into(device.addr, buf)
-
+    def build_frame_format(self, count: int):
         # struct SliderChanges
         # {
         #   uint16_t slider_value[NUM_SLIDERS];
         #   uint8_t slider_changed[NUM_SLIDERS];
         # };
+        return f"<{count}H{count}B"
 
-        format = f"<{num_sliders}H{num_sliders}B"
-        unpacked = struct.unpack(format, buf)
-        slider_values = list(unpacked[:num_sliders])  # first part is unint16
-        slider_changed = list(unpacked[num_sliders:])  # second part is uint8
-
-        return slider_values, slider_changed  # will ignore the "slider_changed" for now
-
-    def update_sliders(self):
-        """Update all sliders"""
-        for device in self.devices:
-            slider_values, slider_changed = self.get_slider_values(device)
-            device.slider_values = slider_values
-            device.slider_changed = slider_changed
+    def get_slider_count(self, device: SliderDevice):
+        """Return the number of sliders in a device. Only used for firmware without a descriptor."""
+        buffer = bytearray(1)
+        command = bytes([0x02, 0x03])  # sliders cmd, get slider number
+        with self.twiman.bus:
+            self.twiman.select_channel(device.channel)
+            if not self.twiman.request(device, command, buffer):
+                return 0
 
-            print(f"slider values: {slider_values}")
-            print(f"slider changed: {slider_changed}")
+        return buffer[0]
 
-            for idx in range(device.num_sliders):
-                current_value = slider_values[idx]
-                if (  # holy format ruff
-                    abs(device.old_slider_values[idx] - current_value)
-                    > self.slider_deadzone
-                ):
-                    device.old_slider_values[idx] = current_value
-                    self.update_midi(device, idx, current_value)
+    def decode_frame(self, device: SliderDevice):
+        """Decode the last frame the poll pass read from a device into its lists, in place.
+        Values that didn't change aren't copied, see handle_frame. Allocates nothing."""
+        # the layout is device.frame_format, SliderChanges. decoded by hand because unpack makes new tuples
+        buf = device.rx_buffer
+        num_sliders = device.num_sliders
+        slider_changed = device.slider_changed
+        new_slider_values = device.new_slider_values
+
+        for idx in range(num_sliders):
+            new_slider_values[idx] = buf[2 * idx] | buf[2 * idx + 1] << 8  # uint16
+            slider_changed[idx] = buf[2 * num_sliders + idx]
+
+    def handle_frame(self, device: SliderDevice):
+        """Handle the changes of a slider device. Called by the TWIManager poll pass."""
+        self.decode_frame(device)
+
+        active = False
+        for idx in range(device.num_sliders):
+            if not device.slider_changed[idx]:
+                continue  # the module clears the values it didn't change, they aren't real readings
+            active = True
+            current_value = device.new_slider_values[idx]
+            device.slider_values[idx] = current_value
+            filtered = self.filter_value(device.old_slider_values[idx], current_value)
+            if filtered != device.old_slider_values[idx]:
+                device.old_slider_values[idx] = filtered
+                self.update_midi(device, idx, filtered)
+        return active
+
+    def filter_value(self, filtered: int, value: int):
+        """Hysteresis. The output only moves once the reading is more than slider_hysteresis away from it,
+        and then trails the reading by that much. The output snaps to the ends, so they can still be reached
+        and jitter next to them doesn't get through."""
+        hysteresis = self.slider_hysteresis
+        if value > filtered + hysteresis:
+            filtered = value - hysteresis
+        elif value < filtered - hysteresis:
+            filtered = value + hysteresis
+
+        if filtered >= self.slider_max - 2 * hysteresis:
+            return self.slider_max
+        if filtered <= 2 * hysteresis:
+            return 0
+        return filtered
+
+    def control_count(self, device: SliderDevice):
+        return device.num_sliders
 
     def get_midi_index(self, device: SliderDevice, slider_idx: int):
-        """A stable index for our MIDI messages. When a device is removed the index will change, otherwise it will not."""
-        midi_index = 0
-        for d in self.devices:
-            if d == device:
-                break
-            midi_index += d.num_sliders
-        return midi_index + slider_idx
+        """A stable index for our MIDI messages. When a device is removed the index will change, otherwise it will not.
+        Set pin_controls to keep the index of replugged devices."""
+        return self.get_control_index(device, slider_idx)
+
+    def get_controller(self, midi_index: int):
+        """The CC a slider sends on (the MSB in high resolution mode), or None if it's past the last controller"""
+        controller = midi_index
+        if self.high_resolution and midi_index >= 32:
+            controller += 32  # 32-63 are the LSBs of 0-31
+        return controller if controller <= MAX_CONTROLLER else None
 
     def update_midi(self, device: SliderDevice, slider_idx: int, value: int):
-        """Send a MIDI Control Change message for a slider value"""
+        """Queue a MIDI Control Change message for a slider value. Sent after the poll pass, see MidiOutput"""
         midi_index = self.get_midi_index(device, slider_idx)
-        mapped_value = int(map_value(value, 0, 1023, 0, 127))
-
-        self.midi.send(ControlChange(midi_index, mapped_value))
-        print(
-            f"slider {slider_idx} on device {device.get_friend_code()} updated to {mapped_value}"
-        )
-
-    def schedule_tasks(self):
-        """Schedule the slider update task"""
-        scheduler.create_task(self.update_sliders, period_ms=self.update_interval)
-
-    def mod_during_bootup(self, keyboard):
-        self.schedule_tasks()
+        controller = self.get_controller(midi_index)
+        if controller is None:
+            if midi_index not in self.unmapped:
+                self.unmapped.add(midi_index)
+                print(f"slider {midi_index} has no MIDI controller left, ignoring it")
+            return
+        last = device.midi_values[slider_idx]
+
+        if self.high_resolution and midi_index < 32:
+            mapped_value = value * 0x3FFF // self.slider_max  # no floats
+            if mapped_value == last:
+                return
+            msb = mapped_value >> 7
+            # the LSB alone is enough while the MSB stays the same
+            if last < 0 or msb != last >> 7:
+                self.midi.control_change(midi_index, msb)
+            self.midi.control_change(midi_index + 32, mapped_value & 0x7F)
+        else:
+            mapped_value = value * 0x7F // self.slider_max
+            if mapped_value == last:
+                return
+            self.midi.control_change(controller, mapped_value)
+
+        device.midi_values[slider_idx] = mapped_value
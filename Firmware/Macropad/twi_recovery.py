@@ -0,0 +1,212 @@
+import time
+import digitalio
+from supervisor import ticks_ms
+from kmk import scheduler
+from kmk.kmktime import ticks_add, ticks_diff
+
+# what busio raises its OSErrors with. hardcoded, not every port has them all in errno
+EIO = 5
+ENODEV = 19
+ETIMEDOUT = 116
+
+NACK = 0  # nobody answered at that address. the device's problem, not the bus'
+BUS_ERROR = 1  # timeouts, stuck lines, garbage. the whole bus is in trouble
+OTHER = 2  # our own bugs (bad buffers, bad addresses...). nothing to recover from
+
+
+def classify(error):
+    """Sort a bus exception into NACK, BUS_ERROR or OTHER"""
+    if isinstance(error, OSError):
+        code = error.args[0] if error.args else None
+        if code == ENODEV:
+            return NACK
+        return BUS_ERROR  # EIO, ETIMEDOUT and whatever else the port comes up with
+    if isinstance(error, RuntimeError):
+        return BUS_ERROR  # "SDA or SCL needs a pull up" and friends
+    return OTHER
+
+
+class BusRecovery:
+    """Keeps the I2C bus of a TWIManager alive.
+
+    Bus errors are retried a couple of times with a short backoff. If that doesn't help, a recovery runs
+    from the scheduler: SCL is clocked until a stuck slave lets go of SDA and busio is made again. It's
+    retried later, waiting longer each time, while it keeps failing. Devices that keep causing trouble
+    (bus errors, dropping off and coming back) are quarantined for a while: still registered, not polled.
+    """
+
+    def __init__(self, twiman):
+        self.twiman = twiman
+
+        # ! seconds ! retries block the loop, so they're short and there's few of them
+        self.max_retries = 2
+        self.retry_delay = 0.0005  # doubled every retry
+        self.max_retry_delay = 0.002
+        self.clock_delay = 0.00001  # half an SCL period while clearing the bus. ~50 kHz
+
+        # ! milliseconds !
+        self.recovery_delay = 5
+        self.max_recovery_delay = 2000
+        self.next_recovery_delay = self.recovery_delay
+        # a recovery is scheduled. the poll pass stays off the bus until then
+        self.recovering = False
+        self.last_recovery = None
+
+        # flapping modules. max_strikes within strike_window and they're out for a while,
+        # twice as long every time it happens again
+        self.max_strikes = 3
+        self.strike_window = 30000
+        self.quarantine_time = 5000
+        self.max_quarantine_time = 120000
+        self.strikes = {}  # friend code -> [strikes, ticks of the first one]
+        self.quarantined = {}  # friend code -> ticks it's allowed back
+        self.quarantine_times = {}  # friend code -> how long it was out last time
+
+        self.counters = {
+            "nacks": 0,
+            "bus_errors": 0,
+            "retries": 0,
+            "recoveries": 0,
+            "failed_recoveries": 0,
+            "quarantines": 0,
+        }
+
+    def retry(self, error, func, *args):
+        """Retry a bus operation that just failed with error, if it's worth it. The bus must still be locked.
+        Raises the last error if it keeps failing."""
+        if classify(error) != BUS_ERROR:
+            raise error
+
+        delay = self.retry_delay
+        for _ in range(self.max_retries):
+            self.counters["retries"] += 1
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+            try:
+                return func(*args)
+            except Exception as e:
+                if classify(e) != BUS_ERROR:
+                    raise
+                error = e
+        raise error
+
+    def note_error(self, error, device=None):
+        """Count a failed transaction and start a recovery if the bus is in trouble. Returns the error kind."""
+        kind = classify(error)
+        if kind == NACK:
+            self.counters["nacks"] += 1
+        elif kind == BUS_ERROR:
+            self.counters["bus_errors"] += 1
+            if device is not None:
+                self.strike(device)
+            self.schedule_recovery()
+        return kind
+
+    def schedule_recovery(self):
+        if self.recovering:
+            return
+        self.recovering = True
+
+        # the backoff starts over if the last recovery was a while ago
+        if (
+            self.last_recovery is not None
+            and ticks_diff(ticks_ms(), self.last_recovery) > self.max_recovery_delay * 2
+        ):
+            self.next_recovery_delay = self.recovery_delay
+        scheduler.create_task(self.recover, after_ms=self.next_recovery_delay)
+
+    def recover(self):
+        """Free a stuck bus and make busio again. Runs from the scheduler, never in the middle of a transaction."""
+        self.counters["recoveries"] += 1
+        self.last_recovery = ticks_ms()
+        delay = self.next_recovery_delay
+        self.next_recovery_delay = min(delay * 2, self.max_recovery_delay)
+
+        try:
+            self.twiman.i2c.deinit()
+        except Exception:
+            pass  # it's broken anyway
+
+        try:
+            if not self.clear_bus():
+                print("bus recovery: SDA is still held low")
+            self.twiman.reinit_bus()
+        except Exception as e:
+            self.counters["failed_recoveries"] += 1
+            print(
+                f"bus recovery failed: {e}. trying again in {self.next_recovery_delay} ms"
+            )
+            scheduler.create_task(self.recover, after_ms=self.next_recovery_delay)
+            return
+
+        self.recovering = False
+        print(f"bus recovered ({self.counters['recoveries']} so far)")
+
+    def clear_bus(self):
+        """Clock SCL until whoever holds SDA low lets go, then send a STOP. Returns True if SDA is free.
+        busio has to be deinited, the pins are taken over for a bit."""
+        scl = digitalio.DigitalInOut(self.twiman.scl_pin)
+        sda = digitalio.DigitalInOut(self.twiman.sda_pin)
+        try:
+            sda.switch_to_input(pull=digitalio.Pull.UP)
+            scl.switch_to_output(value=True, drive_mode=digitalio.DriveMode.OPEN_DRAIN)
+
+            # a slave in the middle of a byte is done after 9 clocks at most
+            for _ in range(9):
+                if sda.value:
+                    break
+                scl.value = False
+                time.sleep(self.clock_delay)
+                scl.value = True
+                time.sleep(self.clock_delay)
+
+            # STOP: SDA goes up while SCL is high
+            scl.value = False
+            sda.switch_to_output(value=False, drive_mode=digitalio.DriveMode.OPEN_DRAIN)
+            time.sleep(self.clock_delay)
+            scl.value = True
+            time.sleep(self.clock_delay)
+            sda.value = True
+            time.sleep(self.clock_delay)
+
+            sda.switch_to_input(pull=digitalio.Pull.UP)
+            return sda.value
+        finally:
+            scl.deinit()
+            sda.deinit()
+
+    def strike(self, device):
+        """A device caused trouble. Too many strikes in a row and it's quarantined."""
+        friend_code = device.get_friend_code()
+        now = ticks_ms()
+        entry = self.strikes.get(friend_code)
+        if entry is None or ticks_diff(now, entry[1]) > self.strike_window:
+            entry = self.strikes[friend_code] = [0, now]
+        entry[0] += 1
+        if entry[0] >= self.max_strikes:
+            del self.strikes[friend_code]
+            self.quarantine(device, friend_code, now)
+
+    def quarantine(self, device, friend_code, now):
+        duration = self.quarantine_times.get(friend_code)
+        duration = (
+            self.quarantine_time
+            if duration is None
+            else min(duration * 2, self.max_quarantine_time)
+        )
+        self.quarantine_times[friend_code] = duration
+        until = self.quarantined[friend_code] = ticks_add(now, duration)
+        self.counters["quarantines"] += 1
+        print(f"{friend_code} keeps failing. not polling it for {duration} ms")
+
+        # a polled device just sits out its turns. nothing to move around mid poll pass
+        if device.owner is not None:
+            device.next_poll = until
+
+    def quarantined_until(self, friend_code):
+        """When a quarantined device is allowed back, or None if it isn't quarantined"""
+        until = self.quarantined.get(friend_code)
+        if until is not None and ticks_diff(until, ticks_ms()) <= 0:
+            del self.quarantined[friend_code]
+            return None
+        return until
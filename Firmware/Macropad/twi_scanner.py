@@ -0,0 +1,57 @@
+import keypad
+from collections import deque
+from kmk.scanners import Scanner
+
+# what a knob's keys are for. key number = knob * KEYS_PER_KNOB + one of these
+CCW = 0
+CW = 1
+BUTTON = 2
+KEYS_PER_KNOB = 3
+
+
+class TWIScanner(Scanner):
+    """Virtual keys for the knobs on the TWIManager modules, as a KMK scanner.
+
+    The poll pass pushes events in here (knob_module.scanner), the main loop picks them up like matrix keys:
+    one queue, in order, through coord_mapping and the keymap. Every knob gets 3 keys (CCW, CW, button) and
+    keeps them for as long as its knob index is stable, so replugging a module doesn't move its keys around.
+
+    Put it in keyboard.matrix next to the real matrix, knobs is how many knobs get keys.
+    """
+
+    def __init__(self, knobs=8, max_events=64):
+        self.knobs = knobs
+        self.max_events = max_events
+        # (key number, pressed), oldest first. presses stop at max_events, and after that only keys that are
+        # down can still be released, one release each at most. so it never fills up and drops something.
+        self.events = deque((), max_events + self.key_count)
+        self.events_dropped = 0
+
+    @property
+    def key_count(self):
+        return self.knobs * KEYS_PER_KNOB
+
+    @property
+    def events_pending(self):
+        return len(self.events) > 0
+
+    def key_number(self, knob: int, key: int):
+        """The key number of a knob's CCW, CW or BUTTON key, or None if the knob has no keys"""
+        if knob >= self.knobs:
+            return None
+        return knob * KEYS_PER_KNOB + key
+
+    def push(self, key_number: int, pressed: bool):
+        """Queue an event for the main loop. Returns False if it was dropped.
+        Only presses are dropped when the queue is full, a release always gets in so nothing stays stuck."""
+        if pressed and len(self.events) >= self.max_events:
+            self.events_dropped += 1
+            return False
+        self.events.append((key_number, pressed))
+        return True
+
+    def scan_for_changes(self):
+        if not self.events:
+            return None
+        key_number, pressed = self.events.popleft()
+        return keypad.Event(key_number + self.offset, pressed)
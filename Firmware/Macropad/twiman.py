@@ -1,5 +1,5 @@
 try:
-    from typing import Callable, Literal, List  # comes from kmk code
+    from typing import Callable, Literal, List, Optional  # comes from kmk code
     from circuitpython_typing import (  # type: ignore
         ReadableBuffer,
         WriteableBuffer,
@@ -11,7 +11,45 @@ from binascii import hexlify
 import time
 import board
 import busio
+from supervisor import ticks_ms
 from kmk import scheduler
+from kmk.kmktime import ticks_add, ticks_diff
+from twi_recovery import BusRecovery, BUS_ERROR, NACK, classify
+
+SEVERAL_CHANNELS = (
+    -1
+)  # TWIManager.selected_channel when a mask (or who knows what) is selected
+
+
+class ModuleDescriptor:
+    """What a module is and what its frames look like. Asked for once per friend code.
+
+    struct ModuleDescriptor { uint8_t module_type, protocol_version, control_count, frame_size; }
+    """
+
+    SIZE = 4
+
+    def __init__(self, type_id, version, count, frame_size):
+        self.type_id = type_id
+        self.version = version
+        self.count = count
+        self.frame_size = frame_size
+
+    @classmethod
+    def from_raw(cls, raw, type_id):
+        """Parse a descriptor read from a module. Old firmware doesn't know the command, that gives None."""
+        if raw is None or len(raw) < cls.SIZE or raw[0] != type_id:
+            return None
+        if raw[1] in (0x00, 0xFF) or raw[2] == 0:
+            return None
+        return cls(raw[0], raw[1], raw[2], raw[3])
+
+    def to_list(self):
+        return [self.type_id, self.version, self.count, self.frame_size]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
 
 
 class TWIDevice:
@@ -25,11 +63,29 @@ class TWIDevice:
         self.type_id = raw_friend_code[0]
         self.raw_serial = raw_friend_code[1:]
         self.serial = hexlify(self.raw_serial).decode("ascii")
+        self.descriptor = None  # ModuleDescriptor, if the firmware has one
+
+        # filled in by the module that owns the device when it joins the poll pass
+        self.owner = None
+        self.poll_command = None
+        self.rx_buffer = None
+        # optional. a one byte dirty bitmap read first, the full frame is only fetched when it isn't 0
+        self.dirty_command = None
+        self.dirty_buffer = bytearray(1)
+        # adaptive polling. see TWIManager.adapt_poll_interval
+        self.poll_interval = 0  # ms
+        self.next_poll = 0
+        self.last_active = 0
 
     def get_friend_code(self):
         """Get the friend code as a string."""
         return f"{self.type_id:02X}{self.serial}"
 
+    @staticmethod
+    def format_friend_code(raw_friend_code):
+        """Get the friend code string of a raw friend code without making a device"""
+        return f"{raw_friend_code[0]:02X}{hexlify(raw_friend_code[1:]).decode('ascii')}"
+
     # This is so a class that inherits can compare itself to a TWIDevice. This lets us be able to delete and... compare.
     def __eq__(self, other):
         return (
@@ -42,6 +98,329 @@ class TWIDevice:
         return hash((self.addr, self.channel))
 
 
+class DeviceRegistry:
+    """Every registered device, indexed by (channel, addr), by friend code and by type id.
+    Adding and removing are O(1), no matter how long the daisy chains get."""
+
+    def __init__(self):
+        self.by_location = {}  # (channel, addr) -> device
+        self.by_friend_code = {}  # friend code -> device
+        self.by_type = {}  # type id -> {(channel, addr): device}
+
+    def add(self, device: TWIDevice):
+        key = (device.channel, device.addr)
+        self.by_location[key] = device
+        self.by_friend_code[device.get_friend_code()] = device
+        if device.type_id not in self.by_type:
+            self.by_type[device.type_id] = {}
+        self.by_type[device.type_id][key] = device
+
+    def remove(self, channel: int, addr):
+        """Remove a device. Returns it, or None if there wasn't one there"""
+        key = (channel, addr)
+        device = self.by_location.pop(key, None)
+        if device is None:
+            return None
+
+        friend_code = device.get_friend_code()
+        if self.by_friend_code.get(friend_code) is device:
+            del self.by_friend_code[friend_code]
+        of_type = self.by_type.get(device.type_id)
+        if of_type is not None:
+            of_type.pop(key, None)
+        return device
+
+    def get(self, channel: int, addr):
+        return self.by_location.get((channel, addr))
+
+    def get_by_friend_code(self, friend_code):
+        return self.by_friend_code.get(friend_code)
+
+    def of_type(self, type_id):
+        """All the devices of a type"""
+        return self.by_type.get(type_id, {}).values()
+
+    def __len__(self):
+        return len(self.by_location)
+
+    def __iter__(self):
+        return iter(self.by_location.values())
+
+    def __contains__(self, device):
+        return (device.channel, device.addr) in self.by_location
+
+
+class BusLockTimeout(Exception):
+    """The I2C bus stayed locked for longer than TWIManager.lock_timeout"""
+
+
+class BusSession:
+    """Holds the I2C bus lock across a multi step transaction (select channel, write command, read...).
+
+        with twiman.bus:
+            twiman.select_channel(channel)
+            twiman.request(device, command, buffer)
+            twiman.request(other_device, other_command, other_buffer)
+
+    Sessions nest. Only the outermost one locks and unlocks, so the TWIManager methods can use one
+    themselves and cost nothing extra when they're called inside a bigger one."""
+
+    def __init__(self, twiman: "TWIManager"):
+        self.twiman = twiman
+        self.depth = 0
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.twiman.lock_bus()
+        self.depth += 1
+        return self.twiman.i2c
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            self.twiman.i2c.unlock()
+        return False
+
+
+class TWIJob:
+    """A resumable bus job. step() does at most one bus operation and returns how many ms to wait
+    before the next step, or None when the job is done. Keeps the keyboard loop running in between."""
+
+    def __init__(self, twiman: "TWIManager"):
+        self.twiman = twiman
+        self.running = False
+        self.task = None  # the same scheduler task is reused for every step
+
+    def start(self, after_ms=1):
+        self.running = True
+        self.reset()
+        self.schedule(after_ms)
+
+    def schedule(self, after_ms):
+        after_ms = max(1, after_ms)  # 0 would run again in the same timeout pass
+        if self.task is None:
+            self.task = scheduler.create_task(self.run, after_ms=after_ms)
+        else:
+            scheduler.create_task(self.task, after_ms=after_ms)
+
+    def run(self):
+        try:
+            with self.twiman.bus:  # one lock for the whole step
+                after_ms = self.step()
+        except Exception as e:
+            print(f"{self.__class__.__name__} failed: {e}")
+            after_ms = None
+
+        if after_ms is None:
+            self.running = False
+            return
+        self.schedule(after_ms)
+
+    def reset(self):
+        return
+
+    def step(self):
+        raise NotImplementedError
+
+
+class DiscoveryJob(TWIJob):
+    """Gives fresh slaves on the default address of a channel their own address.
+    Keeps going while the daisy chain keeps handing out new slaves."""
+
+    PROBE = 0
+    READ_CODE = 1
+    READ_DESCRIPTOR = 2
+    ADDRESS = 3
+    CONFIRM = 4
+
+    def __init__(self, twiman: "TWIManager", channel: int):
+        super().__init__(twiman)
+        self.channel = channel
+        self.state = self.PROBE
+        self.new_addr = None
+        self.raw_friend_code = None
+        self.descriptor = None
+        self.found = 0
+        self.chain_deadline = None  # keep probing until then, the next slave in the chain may still be booting
+
+    def reset(self):
+        self.state = self.PROBE
+        self.new_addr = None
+        self.raw_friend_code = None
+        self.descriptor = None
+        self.found = 0
+        self.chain_deadline = None
+
+    def give_up(self, reason):
+        """Put the address back into the pool and stop"""
+        print(f"CH{self.channel}: {reason}")
+        if self.new_addr is not None:
+            self.twiman.freed_addresses[self.channel].append(self.new_addr)
+            self.new_addr = None
+        return self.finish()
+
+    def finish(self):
+        if self.found > 0:
+            print(f"CH{self.channel}: discovery found {self.found} devices")
+        return None
+
+    def step(self):
+        twiman = self.twiman
+        twiman.select_channel(self.channel)
+
+        if self.state == self.PROBE:
+            # only check the default address. we don't care about the rest lol
+            if not twiman.ping_slave(twiman.default_addr):
+                if (
+                    self.chain_deadline is not None
+                    and ticks_diff(self.chain_deadline, ticks_ms()) > 0
+                ):
+                    return twiman.chain_probe_interval
+                return self.finish()
+            self.chain_deadline = None
+            print(f"CH{self.channel}: found new device at 0x{twiman.default_addr:02X}")
+            self.state = self.READ_CODE
+            return 1
+
+        # the friend code is read before the address change so a known module can get its old address back
+        if self.state == self.READ_CODE:
+            self.raw_friend_code = twiman.read_friend_code(twiman.default_addr)
+            if self.raw_friend_code is None:
+                return self.give_up("friend code read failed")
+            self.descriptor = twiman.get_cached_descriptor(
+                TWIDevice.format_friend_code(self.raw_friend_code)
+            )
+            self.state = self.ADDRESS if self.descriptor else self.READ_DESCRIPTOR
+            return 1
+
+        if self.state == self.READ_DESCRIPTOR:
+            self.descriptor = ModuleDescriptor.from_raw(
+                twiman.read_descriptor(twiman.default_addr), self.raw_friend_code[0]
+            )
+            if self.descriptor is not None:
+                twiman.cache_descriptor(
+                    TWIDevice.format_friend_code(self.raw_friend_code), self.descriptor
+                )
+            self.state = self.ADDRESS
+            return 1
+
+        if self.state == self.ADDRESS:
+            try:
+                self.new_addr = twiman.get_address_for_device(
+                    self.channel, self.raw_friend_code
+                )
+            except Exception as e:
+                return self.give_up(e)
+            if not twiman.send_address_change_command(
+                twiman.default_addr, self.new_addr
+            ):
+                return self.give_up("address change failed")
+            self.state = self.CONFIRM
+            return twiman.address_change_time
+
+        if self.state == self.CONFIRM:
+            if not twiman.ping_slave(self.new_addr):
+                return self.give_up(
+                    f"slave failed to ACK at new address 0x{self.new_addr:02X}"
+                )
+            twiman.register_device(
+                self.channel, self.new_addr, self.raw_friend_code, self.descriptor
+            )
+            print(
+                f"CH{self.channel}: slave successfully changed address to 0x{self.new_addr:02X}"
+            )
+            self.new_addr = None
+            self.found += 1
+            self.state = self.PROBE
+            # the next slave in the chain (if any) shows up a bit later. instead of sleeping through all of it,
+            # probe every now and then so it's picked up as soon as it's there. other channels run in between.
+            self.chain_deadline = ticks_add(ticks_ms(), twiman.chain_settle_time)
+            return twiman.chain_probe_interval
+
+        return self.finish()
+
+
+class DiscoverySweepJob(TWIJob):
+    """Pings the default address on every idle channel at once. Only channels get their own
+    DiscoveryJob if something answered, so an empty pad costs one ping per discovery scan.
+    With a deadline it keeps sweeping until then, for slaves that are still booting."""
+
+    def __init__(self, twiman: "TWIManager"):
+        super().__init__(twiman)
+        self.deadline = None
+
+    def step(self):
+        twiman = self.twiman
+        idle = [
+            channel
+            for channel in twiman.channels
+            if not twiman.discovery_jobs[channel].running
+        ]
+
+        if idle and twiman.select_channels(idle):
+            if twiman.ping_slave(twiman.default_addr):
+                # someone is there. each channel finds out for itself, all of them in parallel
+                for channel in idle:
+                    twiman.discovery_jobs[channel].start()
+
+        if self.deadline is not None and ticks_diff(self.deadline, ticks_ms()) > 0:
+            return twiman.chain_probe_interval
+        self.deadline = None
+        return None
+
+
+class HealthCheckJob(TWIJob):
+    """Pings the active devices nobody talked to lately, one device per step.
+    Devices that are polled prove they're alive with every transaction (see TWIManager.mark_alive)."""
+
+    def __init__(self, twiman: "TWIManager"):
+        super().__init__(twiman)
+        self.targets = []
+        self.checked = 0
+        self.removed = 0
+
+    def reset(self):
+        twiman = self.twiman
+        now = ticks_ms()
+        window = twiman.health_check_interval * 1000
+
+        self.targets.clear()
+        for channel in twiman.channels:
+            last_seen = twiman.last_seen[channel]
+            for addr in twiman.active_addresses[channel]:
+                seen = last_seen.get(addr)
+                if seen is None or ticks_diff(now, seen) >= window:
+                    self.targets.append((channel, addr))
+        self.checked = 0
+        self.removed = 0
+
+    def step(self):
+        if not self.targets:
+            if self.checked > 0:
+                print(
+                    f"health check: {self.checked - self.removed} devices ACKed, {self.removed} removed"
+                )
+            return None
+
+        channel, addr = self.targets.pop()
+        if addr not in self.twiman.active_addresses[channel]:
+            return 1  # already gone
+
+        self.twiman.select_channel(channel)
+        alive = self.twiman.ping_slave(addr)
+        if alive is None:
+            return 1  # bus trouble, not its fault. it's checked again next time
+
+        self.checked += 1
+        if alive:
+            self.twiman.last_seen[channel][addr] = ticks_ms()
+            self.twiman.failures[channel][addr] = 0
+        else:
+            self.twiman.remove_device(channel, addr)
+            self.removed += 1
+        return 1
+
+
 class TWIManager:
     """hello am twiman. I manage I2C devices on a multiplexer."""
 
@@ -52,11 +431,28 @@ class TWIManager:
         mux_addr=0x70,
         mux_channels=1,
         default_addr=0x03,
+        registry=None,
     ):
-        self.i2c = busio.I2C(sda=sda_pin, scl=scl_pin, frequency=400000)
+        self.sda_pin = sda_pin
+        self.scl_pin = scl_pin
+        self.frequency = 400000
+        self.i2c = busio.I2C(sda=sda_pin, scl=scl_pin, frequency=self.frequency)
+        # retries, bus resets, quarantine and error counters (recovery.counters)
+        self.recovery = BusRecovery(self)
+        self.bus = BusSession(self)
+        # ms. the loop is single threaded, so the lock is normally free. if it isn't, someone forgot to
+        # unlock and spinning forever would freeze the whole keyboard
+        self.lock_timeout = 10
+        # command + response in one transaction, with a repeated start in between. turn it off for slaves
+        # that can't answer right away, they get their read retried until they ACK it instead
+        self.repeated_start = True
+        self.ready_timeout = 5  # ms
         self.mux_addr = mux_addr
         self.mux_channels = mux_channels
         self.default_addr = default_addr
+        # optional ModuleRegistry, remembers modules between boots
+        self.registry = registry
+        self.descriptors = {}  # friend code -> ModuleDescriptor
 
         self.max_addr = 0x77
         self.channels = range(self.mux_channels)
@@ -64,60 +460,241 @@ class TWIManager:
         self.next_addr = {channel: 0x04 for channel in self.channels}
         self.freed_addresses = {channel: [] for channel in self.channels}
 
-        self.registered_devices: list[TWIDevice] = []
-
-        self.new_device_callbacks: list[Callable[[TWIDevice], None]] = []
-        self.removed_device_callbacks: list[Callable[[TWIDevice], None]] = []
+        self.registered_devices = DeviceRegistry()
+
+        # liveness. every transaction counts, explicit pings are only for devices nobody talked to lately
+        self.last_seen = {channel: {} for channel in self.channels}  # addr -> ticks
+        self.failures = {
+            channel: {} for channel in self.channels
+        }  # addr -> failures in a row
+        # failed transactions in a row before a device is suspected gone. polls run every few ms,
+        # so a single glitch mustn't be enough. it's pinged once more before it's really removed
+        self.max_failures = 3
+        self.dead_devices = []
+
+        # the mux keeps its channel until told otherwise, so we remember what's selected and skip rewriting it.
+        # None means no channel, SEVERAL_CHANNELS means a mask (or we don't know)
+        self.selected_channel = None
+        # seconds. the TCA9546A switches on the STOP of the write, so nothing to wait for. for muxes that need it
+        self.mux_settle_time = 0
+        self.twi_channels = [None] * 4  # TWIChannel pass throughs, made on demand
+
+        self.polled_devices = {channel: [] for channel in self.channels}
+        self.polled_frames = []  # devices with a fresh frame in their rx_buffer, reused every pass
+        self.poll_order = list(self.channels)
+        # how often the poll pass wakes up. each device decides on its own if it's due (see adapt_poll_interval),
+        # so this should match the fastest poll_fast_ms of the modules.
+        # it's also the grid the due times snap to: devices that share a channel come due on the same passes,
+        # so a channel is visited once per tick and the mux isn't switched back and forth in between
+        self.poll_interval = 5  # ms
+
+        # type id -> callbacks. modules only hear about their own kind of device.
+        self.new_device_callbacks: dict[int, list[Callable[[TWIDevice], None]]] = {}
+        self.removed_device_callbacks: dict[int, list[Callable[[TWIDevice], None]]] = {}
+        # for types nobody registered for. if there's none either, the device is parked:
+        # it stays registered and health checked, but nobody polls it.
+        self.fallback_device_callbacks: list[Callable[[TWIDevice], None]] = []
+        self.fallback_removal_callbacks: list[Callable[[TWIDevice], None]] = []
+        self.parked_devices = {}  # (channel, addr) -> device
 
         # ! seconds !
         # self.last_health_check = 0
-        self.health_check_interval = 2
+        self.health_check_interval = (
+            2  # also how long a device can go without a transaction before it's pinged
+        )
         # self.last_discovery = 0
         self.discovery_interval = 5
         # self.batch_delay = 2.5 :(
 
-    def send_command(self, device: TWIDevice, command: bytes):
-        """Send command to a device"""
+        # ! milliseconds ! waits between the steps of the jobs below
+        self.address_change_time = 70  # slave restarting its TWI + smooth tea time
+        # the next slave in the chain waits 0.5 seconds before showing up
+        self.chain_settle_time = 550
+        self.chain_probe_interval = 50
+
+        self.discovery_jobs = {
+            channel: DiscoveryJob(self, channel) for channel in self.channels
+        }
+        self.discovery_sweep_job = DiscoverySweepJob(self)
+        self.health_check_job = HealthCheckJob(self)
+
+    def lock_bus(self):
+        """Lock the bus, waiting lock_timeout ms at most. Use the bus session instead of calling this."""
+        if self.i2c.try_lock():
+            return
+
+        deadline = ticks_add(ticks_ms(), self.lock_timeout)
+        while not self.i2c.try_lock():
+            if ticks_diff(deadline, ticks_ms()) <= 0:
+                raise BusLockTimeout(
+                    f"I2C bus still locked after {self.lock_timeout} ms"
+                )
+
+    def request(self, device: TWIDevice, command: bytes, buffer: WriteableBuffer):
+        """Send a command to a device and read its response into buffer. One bus transaction, see write_then_read_into"""
         try:
-            while not self.i2c.try_lock():
-                time.sleep(0.001)  # 1ms
-                pass
-
-            self.i2c.writeto(device.addr, command)
+            with self.bus:
+                self.write_then_read_into(device.addr, command, buffer)
 
-            return True
+                self.mark_alive(device)
+                return True
         except Exception as e:
-            print(f"failed to send command to device: {e}")
+            self.transaction_failed(device, e, "request to device failed")
             return False
-        finally:
-            self.i2c.unlock()
 
-    def read_from_device(self, device: TWIDevice, num_bytes: int):
-        """Read bytes from a device"""
-        try:
-            while not self.i2c.try_lock():
-                time.sleep(0.001)  # 1ms
-                pass
+    def write_then_read_into(self, addr, command, buffer):
+        """Send a command and read the response into buffer. The bus must already be locked.
+        The modules answer straight from their request ISR, so with repeated_start it's a single transaction.
+        Without, the read is retried until the slave ACKs it (it's ready), for ready_timeout ms at most."""
+        i2c = self.i2c
+        if self.repeated_start:
+            try:
+                i2c.writeto_then_readfrom(addr, command, buffer)
+            except Exception as e:
+                self.recovery.retry(e, i2c.writeto_then_readfrom, addr, command, buffer)
+            return
 
-            buffer = bytearray(num_bytes)
-            self.i2c.readfrom_into(device.addr, buffer)
+        self.write(addr, command)
+        deadline = None
+        while True:
+            try:
+                i2c.readfrom_into(addr, buffer)
+                return
+            except Exception as e:
+                if classify(e) != NACK:
+                    self.recovery.retry(e, i2c.readfrom_into, addr, buffer)
+                    return
+                # not ready yet
+                if deadline is None:
+                    deadline = ticks_add(ticks_ms(), self.ready_timeout)
+                elif ticks_diff(deadline, ticks_ms()) <= 0:
+                    raise
+
+    def write(self, addr, buffer):
+        """writeto that retries bus errors. The bus must already be locked."""
+        try:
+            self.i2c.writeto(addr, buffer)
+        except Exception as e:
+            self.recovery.retry(e, self.i2c.writeto, addr, buffer)
 
-            return buffer
+    def read_into(self, addr, buffer):
+        """readfrom_into that retries bus errors. The bus must already be locked."""
+        try:
+            self.i2c.readfrom_into(addr, buffer)
         except Exception as e:
-            print(f"failed to read from device: {e}")
-            return None
-        finally:
-            self.i2c.unlock()
+            self.recovery.retry(e, self.i2c.readfrom_into, addr, buffer)
+
+    def transaction_failed(self, device: TWIDevice, error, what):
+        """Work out who's to blame for a failed transaction. A NACK is the device's fault,
+        a bus error isn't necessarily, so that one gets the bus recovered instead of the device removed."""
+        print(f"{what}: {error}")
+        if isinstance(error, BusLockTimeout):
+            return  # never got to talk to it
+        if self.recovery.note_error(error, device) != BUS_ERROR:
+            self.mark_failed(device)
+
+    def reinit_bus(self):
+        """Make busio again after a bus recovery. Nobody knows where the mux is anymore."""
+        self.i2c = busio.I2C(
+            sda=self.sda_pin, scl=self.scl_pin, frequency=self.frequency
+        )
+        self.selected_channel = SEVERAL_CHANNELS
+
+    def mark_alive(self, device: TWIDevice):
+        """A transaction with the device worked, no need to ping it for a while"""
+        self.last_seen[device.channel][device.addr] = ticks_ms()
+        self.failures[device.channel][device.addr] = 0
+
+    def mark_failed(self, device: TWIDevice):
+        """A transaction with the device failed. Enough of them in a row and it's considered gone."""
+        failures = self.failures[device.channel]
+        count = failures.get(device.addr, 0) + 1
+        failures[device.addr] = count
+        if (
+            count >= self.max_failures
+            and device.addr in self.active_addresses[device.channel]
+        ):
+            # removed after the current pass, the poll pass might be walking the device lists right now
+            self.dead_devices.append((device.channel, device.addr))
+
+    def remove_dead_devices(self):
+        """Remove the devices that failed too many transactions, if they don't answer a last ping either.
+        The slave keeps its address, so freeing it for a module that's still there means two on one address."""
+        while self.dead_devices:
+            channel, addr = self.dead_devices.pop()
+            if addr not in self.active_addresses[channel]:
+                continue
+
+            self.select_channel(channel)
+            if self.selected_channel != channel:
+                continue  # can't tell. it fails again if it's really gone
+            alive = self.ping_slave(addr)
+            if alive:
+                self.last_seen[channel][addr] = ticks_ms()
+                self.failures[channel][addr] = 0
+            elif alive is not None:
+                self.remove_device(channel, addr)
 
     def add_device_callback(
-        self, callback: Callable[[TWIDevice], None]
+        self, callback: Callable[[TWIDevice], None], type_id: Optional[int] = None
     ):  # makes me feel confident.
-        """Add a callback for new devices"""
-        self.new_device_callbacks.append(callback)
+        """Add a callback for new devices of a type, or for the types nobody handles if type_id is None.
+        Devices that are already registered (parked ones included) are handed to it right away."""
+        if type_id is None:
+            self.fallback_device_callbacks.append(callback)
+            devices = list(self.parked_devices.values())
+            self.parked_devices.clear()
+        else:
+            self.new_device_callbacks.setdefault(type_id, []).append(callback)
+            devices = list(self.registered_devices.of_type(type_id))
+            for device in devices:
+                self.parked_devices.pop((device.channel, device.addr), None)
+
+        for device in devices:
+            self.call_device_callback(callback, device)
+
+    def add_removal_callback(
+        self, callback: Callable[[TWIDevice], None], type_id: Optional[int] = None
+    ):
+        """Add a callback for removed devices of a type, or for the types nobody handles if type_id is None"""
+        if type_id is None:
+            self.fallback_removal_callbacks.append(callback)
+        else:
+            self.removed_device_callbacks.setdefault(type_id, []).append(callback)
+
+    def call_device_callback(self, callback, device: TWIDevice):
+        try:
+            callback(device)
+        except Exception as e:
+            print(f"HOW. failed to call new callback: {e}")
+
+    def dispatch_new_device(self, device: TWIDevice):
+        """Hand a new device to whoever handles its type. Park it if nobody does."""
+        callbacks = self.new_device_callbacks.get(device.type_id)
+        if not callbacks:
+            callbacks = self.fallback_device_callbacks
+        if not callbacks:
+            self.parked_devices[(device.channel, device.addr)] = device
+            print(
+                f"CH{device.channel}: nobody handles type 0x{device.type_id:02X}, parking {device.get_friend_code()}"
+            )
+            return
+
+        for callback in callbacks:
+            self.call_device_callback(callback, device)
+
+    def dispatch_removed_device(self, device: TWIDevice):
+        if self.parked_devices.pop((device.channel, device.addr), None) is not None:
+            return  # nobody knew about it anyway
 
-    def add_removal_callback(self, callback: Callable[[TWIDevice], None]):
-        """Add a callback for removed devices"""
-        self.removed_device_callbacks.append(callback)
+        callbacks = self.removed_device_callbacks.get(device.type_id)
+        if not callbacks:
+            callbacks = self.fallback_removal_callbacks
+        for callback in callbacks:  # this is sooo wrong holy shit.
+            try:
+                callback(device)
+            except Exception as e:
+                print(f"how. failed to call removed callback: {e}")
 
     def get_next_address_for_channel(self, channel: int):
         """Get next available address for channel"""  # i hate this way of commenting methods.
@@ -137,6 +714,27 @@ class TWIManager:
 
         raise Exception(f"somehow we ran out of addresses for channel {channel}")
 
+    def get_address_for_device(self, channel: int, raw_friend_code):
+        """Get an address for a new device. Known modules get the address they had last time if it's free."""
+        if self.registry is not None:
+            entry = self.registry.get(TWIDevice.format_friend_code(raw_friend_code))
+            hint = entry.get("addr") if entry else None
+            if (
+                hint is not None
+                and hint[0] == channel
+                and hint[1] not in self.active_addresses[channel]
+                and hint[1] != self.mux_addr
+                and hint[1] != self.default_addr
+                and 0x04 <= hint[1] <= self.max_addr
+            ):
+                addr = hint[1]
+                if addr in self.freed_addresses[channel]:
+                    self.freed_addresses[channel].remove(addr)
+                print(f"CH{channel}: handing back 0x{addr:02X}")
+                return addr
+
+        return self.get_next_address_for_channel(channel)
+
     def free_address(self, channel: int, addr):
         """Free an address in a specific channel for reuse"""
         if addr in self.active_addresses[channel]:
@@ -145,233 +743,276 @@ class TWIManager:
 
             print(f"CH{channel}: freed address 0x{addr:02X}")
 
+    def switch_channel(self, channel):
+        """Point the mux at a channel. The bus must already be locked."""
+        if channel == self.selected_channel:
+            return  # already there. no write, no settle
+
+        channel_byte = 0x00 if channel is None else 1 << channel
+        # if the write fails we have no idea where the mux is
+        self.selected_channel = SEVERAL_CHANNELS
+        self.write(self.mux_addr, bytes([channel_byte]))
+        if self.mux_settle_time:
+            time.sleep(self.mux_settle_time)
+        self.selected_channel = channel
+
     def select_channel(self, channel: int):
         """Select a multiplexer channel"""
-        try:
-            while not self.i2c.try_lock():  # spinning. woo
-                time.sleep(0.001)  # 1ms
-                pass
+        if channel == self.selected_channel:
+            return
 
-            channel_byte = 1 << channel
-            self.i2c.writeto(self.mux_addr, bytes([channel_byte]))
-            time.sleep(0.005)
+        try:
+            with self.bus:
+                self.switch_channel(channel)
         except Exception as e:
             print(f"failed to select channel: {channel}: {e}")
-        finally:
-            self.i2c.unlock()
+            self.recovery.note_error(e)
 
-    def unselect_channel(self, channel: int):
-        """Select a multiplexer channel"""
-        try:
-            while not self.i2c.try_lock():  # spinning. woo
-                time.sleep(0.001)  # 1ms
-                pass
+    def select_channels(self, channels):
+        """Enable several mux channels at once. Only for things that can't collide across channels,
+        like pinging the default address: if more than one slave ACKs, it's still an ACK."""
+        mask = 0
+        for channel in channels:
+            mask |= 1 << channel
 
-            self.i2c.writeto(self.mux_addr, bytes([0x00]))
-            time.sleep(0.005)
+        try:
+            with self.bus:
+                # the next select_channel has to write the mux again, whatever channel it is
+                self.selected_channel = SEVERAL_CHANNELS
+                self.write(self.mux_addr, bytes([mask]))
+                if self.mux_settle_time:
+                    time.sleep(self.mux_settle_time)
+                return True
         except Exception as e:
-            print(f"failed to select channel: {channel}: {e}")
-        finally:
-            self.i2c.unlock()
+            print(f"failed to select channels: {mask:04b}: {e}")
+            self.recovery.note_error(e)
+            return False
 
-    def ping_slave(self, addr):
-        """Quick ping to check if a slave responds with an ACK"""
+    def add_polled_device(self, device: TWIDevice, owner):
+        """Add a device to the poll pass. Its frames are handed to owner.handle_frame(device)"""
+        device.owner = owner
+        device.poll_interval = owner.poll_fast_ms
+        device.next_poll = device.last_active = ticks_ms()
+        # a quarantined module sits out its turns until it's allowed back
+        until = self.recovery.quarantined_until(device.get_friend_code())
+        if until is not None:
+            device.next_poll = until
+        self.polled_devices[device.channel].append(device)
+
+    def remove_polled_device(self, device: TWIDevice):
+        """Take a device out of the poll pass"""
+        devices = self.polled_devices.get(device.channel)
+        if devices and device in devices:
+            devices.remove(device)
+
+    def poll_all_devices(self):
+        """One poll pass over every channel. Each channel is selected once and every device that is due
+        is read into its rx_buffer. Frames are dispatched after the bus work is done.
+        Runs every few ms, so nothing in here should allocate once it's warmed up."""
+        if self.recovery.recovering:
+            return  # the bus is getting fixed. nothing would work anyway
+
+        ready = self.polled_frames
+        now = ticks_ms()
+        # the tick of this pass, on the poll_interval grid. late passes don't drag the due times along
+        now -= now % self.poll_interval
+
+        # the channel that's already selected goes first and doesn't need a switch.
+        # a list we keep around and reorder, instead of making a new one every pass
+        order = self.poll_order
+        if self.selected_channel in order and order[0] != self.selected_channel:
+            idx = order.index(self.selected_channel)
+            order[0], order[idx] = order[idx], order[0]
+
+        # one lock for the whole pass. the selects, commands and reads inside don't lock again
         try:
-            while not self.i2c.try_lock():
-                time.sleep(0.001)  # 1ms
-                pass
+            with self.bus:
+                for channel in order:
+                    if self.recovery.recovering:
+                        break  # the rest of the pass would only hit the same stuck bus
+                    for device in self.polled_devices[channel]:
+                        if ticks_diff(now, device.next_poll) < 0:
+                            continue  # not due yet
+                        if self.recovery.recovering:
+                            break
+
+                        self.select_channel(channel)  # free if it's already selected
+                        if self.selected_channel != channel:
+                            break
+
+                        if device.dirty_command is not None:
+                            if not self.request(
+                                device, device.dirty_command, device.dirty_buffer
+                            ):
+                                continue
+                            if device.dirty_buffer[0] == 0:
+                                # nothing moved. that byte was all it cost
+                                self.adapt_poll_interval(device, False, now)
+                                continue
+
+                        if self.request(device, device.poll_command, device.rx_buffer):
+                            ready.append(device)
+
+        except BusLockTimeout as e:
+            print(f"poll pass skipped: {e}")
+            return
+
+        for device in ready:
+            active = True
+            try:
+                active = device.owner.handle_frame(device)
+            except Exception as e:
+                print(f"failed to handle frame from 0x{device.addr:02X}: {e}")
+            self.adapt_poll_interval(device, active, now)
+        ready.clear()
+
+        self.remove_dead_devices()
+
+    def adapt_poll_interval(self, device: TWIDevice, active, now):
+        """Poll a device fast right after it moved, then back off towards its owner's idle rate.
+        now is the tick of the pass, the next poll lands on the grid too."""
+        owner = device.owner
+        if active:
+            device.poll_interval = owner.poll_fast_ms
+            device.last_active = now
+        elif ticks_diff(now, device.last_active) >= owner.poll_hold_ms:
+            device.poll_interval = min(
+                owner.poll_idle_ms,
+                max(owner.poll_fast_ms, device.poll_interval * owner.poll_decay),
+            )
+        grid = self.poll_interval
+        device.next_poll = ticks_add(now, -(-device.poll_interval // grid) * grid)
 
-            self.i2c.writeto(addr, bytes([]))
-            return True
-        except Exception:
-            return False
-        finally:
-            self.i2c.unlock()
+    def ping_slave(self, addr):
+        """Quick ping to check if a slave responds with an ACK.
+        None if the bus had a problem and there's no telling if anyone is there."""
+        try:
+            with self.bus:
+                self.write(addr, bytes([]))
+                return True
+        except Exception as e:
+            if classify(e) == NACK:
+                return False  # nobody there. that's what we're asking, not an error
+            self.recovery.note_error(e)
+            return None
 
     def send_address_change_command(self, old_addr, new_addr):
-        """Send the address change command to a slave"""
+        """Send the address change command to a slave. The slave needs address_change_time ms before it answers again."""
         try:
-            while not self.i2c.try_lock():
-                time.sleep(0.001)  # 1ms
-                pass
-
-            command = bytes([0x00, 0x02, new_addr])
-            self.i2c.writeto(old_addr, command)
-            time.sleep(0.05)  # 50 ms
+            with self.bus:
+                command = bytes([0x00, 0x02, new_addr])
+                self.write(old_addr, command)
 
-            return True
+                return True
         except Exception as e:
             print(f"address change failed: 0x{old_addr:02X} -> 0x{new_addr:02X}: {e}")
-            # TODO: Might want to restart the whole TWI bus or reset the actual mcu.
+            # a stuck bus gets cleared and busio restarted by the BusRecovery
+            self.recovery.note_error(e)
             return False
-        finally:
-            self.i2c.unlock()
 
-    def get_friend_code_command(self, addr):
-        """Send the address change command to a slave"""
+    def read_friend_code(self, addr):
+        """Ask a slave for its friend code"""
         try:
-            while not self.i2c.try_lock():
-                time.sleep(0.001)  # 1ms
-                pass
-
-            command = bytes([0x00, 0x01])
-            self.i2c.writeto(addr, command)
-            time.sleep(0.005)  # 5 ms
-            buffer = bytearray(11)  # 1 typeid + 10 serial bytes
-            self.i2c.readfrom_into(addr, buffer)
+            with self.bus:
+                buffer = bytearray(11)  # 1 typeid + 10 serial bytes
+                self.write_then_read_into(addr, bytes([0x00, 0x01]), buffer)
 
-            return buffer
+                return buffer
         except Exception as e:
             print(f"failed to get friend code: {e}")
+            self.recovery.note_error(e)
             return None
-        finally:
-            self.i2c.unlock()
-
-    def discover_new_device_on_channel(self, channel: int):
-        """Discovers a new fresh slave using the default address on a specific channel"""
-        self.select_channel(channel)
-        if not self.ping_slave(
-            self.default_addr
-        ):  # only check the default address. we don't care about the rest lol
-            return False
-        print(f"CH{channel}: found new device at 0x{self.default_addr:02X}")
 
+    def read_descriptor(self, addr):
+        """Ask a slave for its ModuleDescriptor"""
         try:
-            new_addr = self.get_next_address_for_channel(channel)
-        except Exception as e:
-            print(f"CH{channel}: {e}")
-            return False
-
-        if not self.send_address_change_command(self.default_addr, new_addr):
-            self.freed_addresses[channel].append(new_addr)  # put it back into the pool
-            return False
+            with self.bus:
+                buffer = bytearray(ModuleDescriptor.SIZE)
+                self.write_then_read_into(addr, bytes([0x00, 0x03]), buffer)
 
-        time.sleep(0.02)  # 20 ms. smooth tea time
-        if not self.ping_slave(new_addr):
-            print(f"CH{channel}: slave failed to ACK at new address 0x{new_addr:02X}")
-            self.freed_addresses[channel].append(new_addr)
-            return False
-
-        device = TWIDevice(new_addr, channel, self.get_friend_code_command(new_addr))
-        self.registered_devices.append(device)
-        self.active_addresses[channel].add(new_addr)
-
-        for callback in (
-            self.new_device_callbacks
-        ):  # i hate this so much but it might actually work.
-            try:
-                callback(device)
-            except Exception as e:
-                print(f"HOW. failed to call new callback: {e}")
-
-        print(f"CH{channel}: slave successfully changed address to 0x{new_addr:02X}")
-        return True
-
-    def health_check_all_active_devices(self):
-        """Health check all active devices across all channels"""
-        # current_time = time.monotonic()
-
-        # if current_time - self.last_health_check < self.health_check_interval:
-        #     return
+                return buffer
+        except Exception as e:
+            print(f"failed to get descriptor: {e}")
+            self.recovery.note_error(e)
+            return None
 
-        dead_devices = []
-        total_checked = (
-            0  # track how many devices we checked. useful for debugging i guess.
+    def get_cached_descriptor(self, friend_code):
+        """The descriptor of a module we already know, from RAM or the registry. None if we have to ask."""
+        descriptor = self.descriptors.get(friend_code)
+        if descriptor is None and self.registry is not None:
+            entry = self.registry.get(friend_code)
+            if entry and "desc" in entry:
+                descriptor = ModuleDescriptor.from_list(entry["desc"])
+                self.descriptors[friend_code] = descriptor
+        return descriptor
+
+    def cache_descriptor(self, friend_code, descriptor: ModuleDescriptor):
+        self.descriptors[friend_code] = descriptor
+        if self.registry is not None:
+            self.registry.update(friend_code, desc=descriptor.to_list())
+
+    def register_device(self, channel: int, addr, raw_friend_code, descriptor=None):
+        """Register a freshly addressed slave and tell everyone about it"""
+        device = TWIDevice(addr, channel, raw_friend_code)
+        device.descriptor = descriptor
+        self.registered_devices.add(device)
+        self.active_addresses[channel].add(addr)
+        self.last_seen[channel][addr] = ticks_ms()
+        self.failures[channel][addr] = 0
+        if self.registry is not None:
+            self.registry.update(device.get_friend_code(), addr=[channel, addr])
+
+        # i hate this so much but it might actually work.
+        self.dispatch_new_device(device)
+        return device
+
+    def remove_device(self, channel: int, addr):
+        """Forget a slave that stopped responding and tell everyone about it"""
+        print(
+            f"CH{channel}: slave 0x{addr:02X} stopped responding. Its going to be removed."
         )
+        self.free_address(channel, addr)
+        self.last_seen[channel].pop(addr, None)
+        self.failures[channel].pop(addr, None)
+        device = self.registered_devices.remove(channel, addr)
+        if device is None:
+            return
 
-        for channel in self.channels:
-            if not self.active_addresses[channel]:
-                continue
-
-            self.select_channel(channel)
-            time.sleep(0.001)
-
-            for addr in self.active_addresses[channel]:
-                total_checked += 1
+        # modules that keep dropping off and coming back get quarantined
+        self.recovery.strike(device)
 
-                if self.ping_slave(addr):
-                    continue
-                else:
-                    dead_devices.append((channel, addr))
+        self.remove_polled_device(device)
+        self.dispatch_removed_device(device)
 
-        for channel, addr in dead_devices:
-            print(
-                f"CH{channel}: slave 0x{addr:02X} stopped responding. Its going to be removed."
-            )
-            self.free_address(channel, addr)
-            for i in range(
-                len(self.registered_devices) - 1, -1, -1
-            ):  # in reverse because we might remove A LOT of beep boops.
-                device = self.registered_devices[i]
-                if device.channel == channel and device.addr == addr:
-                    self.registered_devices.pop(i)
-                    for (
-                        callback
-                    ) in self.removed_device_callbacks:  # this is sooo wrong holy shit.
-                        try:
-                            callback(device)  # Batch callback
-                        except Exception as e:
-                            print(f"how. failed to call removed callback: {e}")
-
-                    break
-
-        # self.last_health_check = current_time
-
-        if total_checked > 0:
-            print(
-                f"health check: {total_checked} devices ACKed, {len(dead_devices)} removed"
-            )
+    def health_check_all_active_devices(self):
+        """Start a health check of all active devices across all channels, unless one is still running"""
+        if not self.health_check_job.running:
+            self.health_check_job.start()
 
     def discovery_scan_all_channels(self):
         """Scans all channels for new devices (slaves) :)"""
-        # current_time = time.monotonic()
-
-        # if current_time - self.last_discovery < self.discovery_interval:
-        #     return
-
-        new_devices = 0  # debug debug debug yay. i hope this works.
-
-        for channel in self.channels:
-            if self.discover_new_device_on_channel(channel):
-                new_devices += 1
-
-        # self.last_discovery = current_time
-
-        if new_devices > 0:
-            print(f"discovery: added {new_devices} new devices")
+        if not self.discovery_sweep_job.running:
+            self.discovery_sweep_job.start()
 
     def initial_discovery(self):
-        """Initial discovery."""
+        """Initial discovery. Sweeps all channels at once for a module settle time while the modules boot.
+        Runs from the scheduler once the keyboard loop starts, so boot doesn't wait on it."""
         print("starting initial module discovery...")
-
-        total_found = 0
-        for channel in self.channels:
-            found_on_channel = 0
-
-            # keep discovering until no more devices at default address. might be inefficient but it works
-            while self.discover_new_device_on_channel(channel):
-                found_on_channel += 1
-                total_found += 1
-
-                # small delay between discoveries to let devices initialize
-                time.sleep(
-                    0.55
-                )  # devices wait 0.5 seconds right now. I might want to change that pretty soon. meh
-
-            if found_on_channel > 0:
-                print(f"CH{channel}: inital discovery found {found_on_channel} devices")
-
-        print(f"initial discovery completed: {total_found} total devices")
+        self.discovery_sweep_job.start()
+        self.discovery_sweep_job.deadline = ticks_add(
+            ticks_ms(), self.chain_settle_time
+        )
 
     def schedule_tasks(self):
-        """Schedule periodic tasks for health checks and discovery scans"""
+        """Schedule periodic tasks for polling, health checks and discovery scans"""
+        scheduler.create_task(self.poll_all_devices, period_ms=self.poll_interval)
         scheduler.create_task(
             self.health_check_all_active_devices,
             period_ms=self.health_check_interval * 1000,
         )
         scheduler.create_task(
             self.discovery_scan_all_channels,
-            period_ms=self.maintenance_interval * 1000,
+            period_ms=self.discovery_interval * 1000,
         )
 
     # compatiblity with direct use as a I2C bus without any multiplexer in the middle (for the oled screen lol)
@@ -384,9 +1025,9 @@ class TWIManager:
     ) -> "TWIChannel":  # hardcoded as hell
         if not 0 <= key <= 3:
             raise IndexError("Channel must be an integer in the range: 0-3.")
-        if self.channels[key] is None:
-            self.channels[key] = TWIChannel(self, key)
-        return self.channels[key]
+        if self.twi_channels[key] is None:
+            self.twi_channels[key] = TWIChannel(self, key)
+        return self.twi_channels[key]
 
 
 class TWIChannel:
@@ -397,14 +1038,22 @@ class TWIChannel:
         self.channel = channel
 
     def try_lock(self) -> bool:
-        """Pass through for try_lock."""
-        self.twiman.select_channel(self.channel)
+        """Pass through for try_lock. Only switches the mux if another channel was selected."""
+        if not self.twiman.i2c.try_lock():
+            return False
+
+        try:
+            self.twiman.switch_channel(self.channel)
+        except Exception as e:
+            print(f"failed to select channel: {self.channel}: {e}")
+            self.twiman.i2c.unlock()
+            return False
 
         return True
 
     def unlock(self) -> bool:
-        """Pass through for unlock."""
-        self.twiman.unselect_channel(self.channel)
+        """Pass through for unlock. The channel stays selected so the next write to it is free."""
+        self.twiman.i2c.unlock()
 
         return None
 
@@ -429,7 +1078,7 @@ class TWIChannel:
     ):
         """Pass through for writeto_then_readfrom."""
         # In linux, at least, this is a special kernel function call
-        if address == self.twiman.address:
+        if address == self.twiman.mux_addr:
             raise ValueError("Device address must be different than TCA9548A address.")
         return self.twiman.i2c.writeto_then_readfrom(
             address, buffer_out, buffer_in, **kwargs
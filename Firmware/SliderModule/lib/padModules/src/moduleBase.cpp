@@ -52,6 +52,10 @@ void ModuleBase::handleTWIRequest()
             Wire.write(friendCode, sizeof(friendCode));
             break;
 
+        case MOONPAD_BASE_DESCRIPTOR:
+            Wire.write((uint8_t *)&descriptor, sizeof(descriptor));
+            break;
+
         case MOONPAD_BASE_SWAP_ADDRESS:
             Wire.end();
             Wire.begin(i2c_buffer[2]);
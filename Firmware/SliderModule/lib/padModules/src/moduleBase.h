@@ -10,11 +10,16 @@ extern uint8_t i2c_buffer[TWI_BUFFER_SIZE]; // this shouldn't be in the header,
 class ModuleBase
 {
 public:
-    explicit ModuleBase(uint8_t moduleType) : moduleType(moduleType)
+    ModuleBase(uint8_t moduleType, uint8_t controlCount, uint8_t frameSize) : moduleType(moduleType)
     {
         instance = this;
         // gen the friend code once at startup
         generateFriendCode();
+
+        descriptor.module_type = moduleType;
+        descriptor.protocol_version = MOONPAD_PROTOCOL_VERSION;
+        descriptor.control_count = controlCount;
+        descriptor.frame_size = frameSize;
     }
 
     /// @brief Begins the communication with the specified I2C address. Defaults to 0x03.
@@ -29,6 +34,8 @@ private:
     // 1 byte for module type, 10 bytes from the serial number
     uint8_t friendCode[11];
 
+    ModuleDescriptor descriptor;
+
     uint8_t moduleType;
 
     void generateFriendCode();
@@ -3,7 +3,6 @@
 #include <Wire.h>
 
 uint8_t i2c_buffer[TWI_BUFFER_SIZE];
-ModuleBase modBase(MOONPAD_MOD_SLIDERS);
 
 #define NUM_SLIDERS 2
 #define SLIDER0_PIN 5
@@ -18,6 +17,7 @@ struct SliderChanges
   uint8_t slider_changed[NUM_SLIDERS];
 };
 volatile SliderChanges changes = {{0, 0}, {0, 0}};
+ModuleBase modBase(MOONPAD_MOD_SLIDERS, NUM_SLIDERS, sizeof(SliderChanges));
 
 void setup()
 {
@@ -68,9 +68,22 @@ void ModuleBase::onRequest()
       memset((void *)&changes, 0, sizeof(changes));
     }
 
+    if (module_cmd == MOONPAD_SLIDERS_GET_DIRTY)
+    {
+      uint8_t dirty = 0;
+      for (uint8_t i = 0; i < NUM_SLIDERS; i++)
+      {
+        if (changes.slider_changed[i])
+        {
+          dirty |= 1 << i;
+        }
+      }
+      Wire.write(dirty);
+    }
+
     if (module_cmd == MOONPAD_SLIDERS_GET_SLIDER_NUMBER)
     {
-      Wire.write((uint8_t *)NUM_SLIDERS, 1);
+      Wire.write((uint8_t)NUM_SLIDERS);
     }
   }
   return;